@@ -0,0 +1,123 @@
+import io
+import struct
+import wave
+from typing import Optional
+
+import numpy as np
+
+# この平均振幅未満のチャンクを無音とみなす
+SILENCE_THRESHOLD = 500
+
+
+def pcm_to_wav_bytes(pcm_bytes, sample_rate=16000, channels=1, sample_width=2):
+    """
+    PCMバイトデータをWAVバイトデータに変換します。
+
+    :param pcm_bytes: PCM形式の音声データ
+    :param sample_rate: サンプルレート
+    :param channels: チャンネル数(モノラル=1、ステレオ=2)
+    :param sample_width: サンプル幅(バイト単位、ex. 16ビット=2)
+    :return: WAV形式の音声データ
+    """
+    with io.BytesIO() as wav_io:
+        # WAVファイルの書き込み用にwaveモジュールを使用
+        with wave.open(wav_io, "wb") as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(sample_width)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm_bytes)
+
+        # バイトデータとして取得
+        wav_bytes = wav_io.getvalue()
+
+    return wav_bytes
+
+
+def wav_to_pcm(wav_bytes):
+    """
+    WAVバイトデータからPCMバイトデータとサンプルレートを取り出します。
+
+    :param wav_bytes: WAV形式の音声データ
+    :return: (PCM形式の音声データ, サンプルレート)
+    """
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav_file:
+        return wav_file.readframes(wav_file.getnframes()), wav_file.getframerate()
+
+
+def wav_header(data_size, sample_rate=16000, channels=1, sample_width=2):
+    """
+    PCMデータ長が確定した後に付与するWAVヘッダー(44バイト)を生成します。
+
+    :param data_size: PCMデータのバイト数
+    :param sample_rate: サンプルレート
+    :param channels: チャンネル数(モノラル=1、ステレオ=2)
+    :param sample_width: サンプル幅(バイト単位、ex. 16ビット=2)
+    :return: WAVヘッダーのバイトデータ
+    """
+    block_align = channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_size,
+        b"WAVE",
+        b"fmt ",
+        16,  # fmtチャンクのサイズ
+        1,  # PCM
+        channels,
+        sample_rate,
+        sample_rate * block_align,
+        block_align,
+        sample_width * 8,
+        b"data",
+        data_size,
+    )
+
+
+def mean_abs_amplitude(pcm_bytes: bytes) -> float:
+    """16bit PCMの平均絶対振幅を返します。"""
+    audio_data = np.frombuffer(pcm_bytes, dtype=np.int16)
+    return float(np.abs(audio_data).mean())
+
+
+def is_low_volume(pcm_bytes: bytes, threshold: float = SILENCE_THRESHOLD) -> bool:
+    return mean_abs_amplitude(pcm_bytes) < threshold
+
+
+def has_nonzero(pcm_bytes: bytes) -> bool:
+    """無音(すべて0)でないかを、Pythonのループを使わずに判定します。"""
+    return bool(np.frombuffer(pcm_bytes, dtype=np.uint8).any())
+
+
+class TurnAssembler:
+    """マイクのチャンクを溜め、一定時間以上の無音でユーザーのターンとして切り出す"""
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        silence_sec: float = 3.0,
+        min_bytes: int = 2048,
+    ) -> None:
+        self.silence_samples = int(sample_rate * silence_sec)
+        self.min_bytes = min_bytes
+        self._block = bytearray()
+        self._silent_samples = 0
+
+    def feed(self, chunk: bytes, is_speech: bool) -> Optional[bytes]:
+        """ターンが終わったら、そのターンの音声を返す"""
+        self._block += chunk
+        if is_speech:
+            self._silent_samples = 0
+        else:
+            self._silent_samples += len(chunk) // 2  # 16bit
+
+        # 一定期間以上の無音区間があれば、ターンの終了判定
+        if self._silent_samples >= self.silence_samples:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[bytes]:
+        """溜めた音声を捨て、短すぎなければターンとして返す"""
+        block, self._block = self._block, bytearray()
+        if len(block) > self.min_bytes:
+            return bytes(block)
+        return None
@@ -0,0 +1,53 @@
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+
+class SttBacklog:
+    """文字起こしを後回しにしたメッセージの一覧をJSON Linesでディスクに保持する
+
+    エントリはアップロード済みのWAVを指すだけなので、音声そのものは持たない。
+    再起動しても残るよう、変更のたびにファイルを書き直す。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.entries: list[dict] = []
+        if self.path.exists():
+            with self.path.open() as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, audio_id: str, blob_name: str, attempts: int = 0) -> None:
+        self.entries.append(
+            {"audio_id": audio_id, "blob_name": blob_name, "attempts": attempts}
+        )
+        self._save()
+
+    def peek(self) -> Optional[dict]:
+        return self.entries[0] if self.entries else None
+
+    def remove(self, entry: dict) -> None:
+        self.entries.remove(entry)
+        self._save()
+
+    def requeue(self, entry: dict, max_attempts: int = 3) -> bool:
+        """失敗したエントリを末尾に回す。max_attempts回失敗したら諦めてFalseを返す"""
+        self.entries.remove(entry)
+        attempts = entry["attempts"] + 1
+        if attempts >= max_attempts:
+            self._save()
+            return False
+        self.append(entry["audio_id"], entry["blob_name"], attempts)
+        return True
+
+    def _save(self) -> None:
+        # 書き込み途中で落ちても壊れないよう、一時ファイルから置き換える
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp_path.open("w") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,144 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass(frozen=True)
+class FrameQuality:
+    max_size: int  # サムネイルの長辺(px)
+    quality: int  # JPEG品質
+
+
+# 高品質から順に並べた段階
+LADDER = [
+    FrameQuality(1024, 85),
+    FrameQuality(1024, 70),
+    FrameQuality(768, 60),
+    FrameQuality(512, 50),
+    FrameQuality(384, 40),
+    FrameQuality(256, 30),
+]
+
+
+class BandwidthGovernor:
+    """session.sendの実測値から、上り帯域に収まるフレームの解像度と品質を選ぶ
+
+    送信の詰まり(キュー待ち時間)か目標ビットレート超過を検知したら1段下げ、
+    回線に余裕がある状態がstep_up_after秒続いたら1段上げる。
+    下げた直後のwindow秒間は、計測窓に下げる前のフレームが残っているので続けて下げない。
+    上げるときは、上げた後の見込みが上限のstep_up_headroom倍に収まることを条件にする。
+    """
+
+    def __init__(
+        self,
+        target_bps: float,
+        ladder: list[FrameQuality] = LADDER,
+        max_queue_delay: float = 0.5,
+        step_up_after: float = 10.0,
+        window: float = 5.0,
+        alpha: float = 0.2,
+        step_up_headroom: float = 0.9,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.target_bps = target_bps
+        self.ladder = ladder
+        self.max_queue_delay = max_queue_delay
+        self.step_up_after = step_up_after
+        self.window = window
+        self.alpha = alpha
+        self.step_up_headroom = step_up_headroom
+        self.clock = clock
+
+        self.level = 1
+        self.queue_delay = 0.0  # EWMA(秒)
+        self.throughput = None  # 送信中の実効スループットのEWMA(bps)
+        self.frame_bytes: dict[int, int] = {}  # 段階ごとの直近のフレームサイズ
+
+        self._sent: deque[tuple[float, int]] = deque()
+        self._frames: deque[float] = deque(maxlen=32)
+        self._last_change = clock()
+        self._last_decision = clock()
+
+    @property
+    def current(self) -> FrameQuality:
+        return self.ladder[self.level]
+
+    @property
+    def upstream_bps(self) -> float:
+        if not self._sent:
+            return 0.0
+        return sum(n for _, n in self._sent) * 8 / self.window
+
+    def record_frame(self, nbytes: int) -> None:
+        self.frame_bytes[self.level] = nbytes
+        self._frames.append(self.clock())
+
+    def record_send(self, nbytes: int, send_time: float, queue_delay: float) -> None:
+        now = self.clock()
+        self._sent.append((now, nbytes))
+        while self._sent and self._sent[0][0] < now - self.window:
+            self._sent.popleft()
+
+        self.queue_delay += self.alpha * (queue_delay - self.queue_delay)
+        if send_time > 0:
+            bps = nbytes * 8 / send_time
+            if self.throughput is None:
+                self.throughput = bps
+            else:
+                self.throughput += self.alpha * (bps - self.throughput)
+
+        # 判断は1秒に1回まで
+        if now - self._last_decision >= 1.0:
+            self._last_decision = now
+            self._decide(now)
+
+    @property
+    def budget_bps(self) -> float:
+        # 実測スループットの8割と目標値の小さい方を上限とする
+        if self.throughput is None:
+            return self.target_bps
+        return min(self.target_bps, self.throughput * 0.8)
+
+    def _decide(self, now: float) -> None:
+        upstream = self.upstream_bps
+        congested = self.queue_delay > self.max_queue_delay or upstream > self.budget_bps
+        if congested:
+            settled = now - self._last_change >= self.window
+            if self.level < len(self.ladder) - 1 and settled:
+                self._change(self.level + 1, now, upstream)
+            return
+
+        if (
+            self.level > 0
+            and self.queue_delay < self.max_queue_delay / 4
+            and now - self._last_change >= self.step_up_after
+            and self._projected_bps(self.level - 1, upstream)
+            <= self.budget_bps * self.step_up_headroom
+        ):
+            self._change(self.level - 1, now, upstream)
+
+    def _projected_bps(self, level: int, upstream: float) -> float:
+        # 一度も計測していない段階は、上げてみて判断する
+        if level not in self.frame_bytes or self.level not in self.frame_bytes:
+            return upstream
+        delta = self.frame_bytes[level] - self.frame_bytes[self.level]
+        return upstream + self._frame_rate() * delta * 8
+
+    def _frame_rate(self) -> float:
+        # 窓内のフレーム数ではなく、直近のフレーム間隔から1秒あたりの枚数を求める
+        now = self.clock()
+        recent = [t for t in self._frames if t >= now - self.window * 4]
+        if len(recent) < 2 or recent[-1] == recent[0]:
+            return 0.0
+        return (len(recent) - 1) / (recent[-1] - recent[0])
+
+    def _change(self, level: int, now: float, upstream: float) -> None:
+        previous = self.ladder[self.level]
+        self.level = level
+        self._last_change = now
+        print(
+            f"[bandwidth] {previous.max_size}px/q{previous.quality} -> "
+            f"{self.current.max_size}px/q{self.current.quality} "
+            f"(upstream={upstream / 1000:.0f}kbps, queue_delay={self.queue_delay:.2f}s)"
+        )
@@ -0,0 +1,379 @@
+"""マイクとカメラのキャプチャ・エンコードを別プロセスで行う
+
+ラズパイではGILを共有するとフレームのJPEGエンコードが音声の読み書きを遅らせるので、
+キャプチャ用のワーカープロセスでPCMチャンクとJPEGを作り、共有メモリの
+リングバッファ(ShmRing)経由でメインプロセスに渡す。
+メインプロセスはリングを読んで送信をスケジュールするだけになる。
+"""
+
+import asyncio
+import multiprocessing
+import statistics
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import AsyncIterator, Optional
+
+# ヘッダー: 最新の書き込み番号(uint64)、スロット数(uint32)、スロットの最大長(uint32)
+_HEADER = struct.Struct("<QII")
+# スロット: 書き込み番号(uint64)、データ長(uint32)、パディング
+_SLOT = struct.Struct("<QI4x")
+
+
+class ShmRing:
+    """単一書き込み・複数読み出しの共有メモリのリングバッファ
+
+    各スロットに書き込み番号を持たせ、読み出し側は読み出し前後で番号が
+    変わっていないこと(seqlock)を確かめる。追い越されたスロットは読み飛ばす。
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        slots: int = 64,
+        slot_size: int = 4096,
+    ) -> None:
+        if name is None:
+            size = _HEADER.size + slots * (_SLOT.size + slot_size)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            _HEADER.pack_into(self.shm.buf, 0, 0, slots, slot_size)
+            self.owner = True
+        else:
+            # 解放(unlink)は作成したプロセスが行う
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        _, self.slots, self.slot_size = _HEADER.unpack_from(self.shm.buf, 0)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def latest(self) -> int:
+        return _HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def _offset(self, seq: int) -> int:
+        return _HEADER.size + (seq % self.slots) * (_SLOT.size + self.slot_size)
+
+    def write(self, data) -> int:
+        if len(data) > self.slot_size:
+            raise ValueError(f"{len(data)} bytes exceeds slot size {self.slot_size}")
+        seq = self.latest + 1
+        offset = self._offset(seq)
+        buf = self.shm.buf
+        # 書き込み中は番号を0にして、読み出し側に無効なスロットだと分かるようにする
+        _SLOT.pack_into(buf, offset, 0, 0)
+        start = offset + _SLOT.size
+        buf[start : start + len(data)] = data
+        _SLOT.pack_into(buf, offset, seq, len(data))
+        _HEADER.pack_into(buf, 0, seq, self.slots, self.slot_size)
+        return seq
+
+    def read(self, after: int) -> Optional[tuple[int, bytes]]:
+        """after番より後の最も古い読み出し可能なデータを返す"""
+        latest = self.latest
+        if latest <= after:
+            return None
+        seq = max(after + 1, latest - self.slots + 1)
+        offset = self._offset(seq)
+        buf = self.shm.buf
+        slot_seq, length = _SLOT.unpack_from(buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + _SLOT.size
+        data = bytes(buf[start : start + length])
+        if _SLOT.unpack_from(buf, offset)[0] != seq:
+            # 読んでいる間に上書きされた
+            return None
+        return seq, data
+
+    def close(self) -> None:
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class JitterMeter:
+    """音声チャンクの到着間隔のばらつきとCPU使用率を計測する"""
+
+    def __init__(self, expected_interval: float, window: int = 1000) -> None:
+        self.expected_interval = expected_interval
+        self.window = window
+        self._deviations: list[float] = []
+        self._last_arrival: Optional[float] = None
+        self._started = time.monotonic()
+        self._cpu_started = time.process_time()
+
+    def record(self) -> None:
+        now = time.monotonic()
+        if self._last_arrival is not None:
+            self._deviations.append(now - self._last_arrival - self.expected_interval)
+            if len(self._deviations) > self.window:
+                del self._deviations[: -self.window]
+        self._last_arrival = now
+
+    def report(self, worker_cpu: float = 0.0) -> str:
+        elapsed = time.monotonic() - self._started
+        cpu = time.process_time() - self._cpu_started + worker_cpu
+        jitter = "n/a"
+        if len(self._deviations) > 1:
+            stdev = statistics.pstdev(self._deviations) * 1000
+            worst = max(abs(d) for d in self._deviations) * 1000
+            jitter = f"stdev={stdev:.1f}ms max={worst:.1f}ms"
+        return f"[capture] audio jitter {jitter}, cpu={cpu / elapsed * 100:.0f}%"
+
+
+def _capture_audio(
+    ring: ShmRing, stop, mic_device_index: int, rate: int, chunk_size: int
+):
+    import pyaudio
+
+    from agent.resample import StreamingResampler
+
+    audio_interface = pyaudio.PyAudio()
+    info = audio_interface.get_device_info_by_index(mic_device_index)
+    capture_rate = int(info["defaultSampleRate"])
+    capture_chunk_size = chunk_size * capture_rate // rate
+    resampler = None
+    if capture_rate != rate:
+        resampler = StreamingResampler(capture_rate, rate)
+
+    stream = audio_interface.open(
+        format=pyaudio.paInt16,
+        channels=1,
+        rate=capture_rate,
+        input=True,
+        input_device_index=mic_device_index,
+        frames_per_buffer=capture_chunk_size,
+    )
+    try:
+        while not stop.is_set():
+            data = stream.read(capture_chunk_size, exception_on_overflow=False)
+            if resampler:
+                data = resampler.process(data)
+            ring.write(data)
+    finally:
+        stream.close()
+        audio_interface.terminate()
+
+
+def _capture_frames(ring: ShmRing, stop, controls):
+    import cv2
+
+    from agent.frames import encode_frame, open_picamera, to_rgb
+
+    picam2 = open_picamera()
+    cap = None
+    if not picam2:
+        cap = cv2.VideoCapture(0)
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc("M", "J", "P", "G"))
+
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            if controls["paused"].value:
+                stop.wait(0.5)
+                continue
+            if picam2:
+                frame_rgb = to_rgb(picam2.capture_array())
+            else:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            image_bytes = encode_frame(
+                frame_rgb,
+                max_size=controls["max_size"].value,
+                quality=controls["quality"].value,
+            )
+            ring.write(image_bytes)
+            elapsed = time.monotonic() - started
+            stop.wait(max(0.0, controls["interval"].value - elapsed))
+    finally:
+        if picam2:
+            picam2.stop()
+        if cap:
+            cap.release()
+
+
+def _run_capture(target, name: str, stop, done, errors: list[str], *args) -> None:
+    # スレッドが終わったらdoneを立てて、メインプロセスに知らせる
+    try:
+        target(*args)
+        if not stop.is_set():
+            errors.append(f"{name} capture stopped unexpectedly")
+    except BaseException as e:
+        errors.append(f"{name} capture failed: {e!r}")
+    finally:
+        if errors:
+            print(f"[capture] {errors[-1]}", file=sys.stderr)
+        done.set()
+
+
+def _worker(
+    audio_ring_name: str,
+    frame_ring_name: str,
+    stop,
+    frames_done,
+    controls,
+    cpu_seconds,
+    error,
+    mic_device_index: int,
+    rate: int,
+    chunk_size: int,
+) -> None:
+    audio_ring = ShmRing(audio_ring_name)
+    frame_ring = ShmRing(frame_ring_name)
+    errors: list[str] = []
+    # マイクとカメラはブロッキングで読むので、プロセス内でスレッドを分ける。
+    # 音声が止まったらワーカーごと止めるが、カメラがない・読めなくなったときは
+    # フレームだけを終わらせて音声は続ける(プロセス内で読むときと同じ)
+    threads = [
+        threading.Thread(
+            target=_run_capture,
+            args=(
+                _capture_audio,
+                "audio",
+                stop,
+                stop,
+                errors,
+                audio_ring,
+                stop,
+                mic_device_index,
+                rate,
+                chunk_size,
+            ),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=_run_capture,
+            args=(
+                _capture_frames,
+                "frame",
+                stop,
+                frames_done,
+                [],
+                frame_ring,
+                stop,
+                controls,
+            ),
+            daemon=True,
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    while not stop.wait(1.0):
+        cpu_seconds.value = time.process_time()
+    for thread in threads:
+        thread.join(timeout=2.0)
+    audio_ring.close()
+    frame_ring.close()
+    if errors:
+        error.value = "; ".join(errors).encode()[: len(error) - 1]
+        sys.exit(1)
+
+
+class CaptureProcess:
+    """キャプチャ用のワーカープロセスと、その出力を読むリングバッファ"""
+
+    def __init__(
+        self,
+        mic_device_index: int,
+        rate: int = 16000,
+        chunk_size: int = 1024,
+        frame_slot_size: int = 1024 * 1024,
+    ) -> None:
+        # gRPCなどのスレッドを抱えたままforkしないようにspawnで起動する。
+        # spawnの子プロセスは起動元の__main__(python -m agent.mainならagent.main)を
+        # 読み込み直すので、GoogleのクライアントはAPIを使うときに初めて作っている
+        ctx = multiprocessing.get_context("spawn")
+        self.audio_ring = ShmRing(slots=64, slot_size=chunk_size * 2 * 2)
+        self.frame_ring = ShmRing(slots=4, slot_size=frame_slot_size)
+        self.stop_event = ctx.Event()
+        # フレームのスレッドが終わったら立つ。音声とは違い、プロセスは止めない
+        self.frames_done = ctx.Event()
+        self.controls = {
+            "max_size": ctx.Value("i", 1024),
+            "quality": ctx.Value("i", 75),
+            "interval": ctx.Value("d", 2.0),
+            "paused": ctx.Value("b", False),
+        }
+        self.cpu_seconds = ctx.Value("d", 0.0)
+        # ワーカーが異常終了したときの理由
+        self.error = ctx.Array("c", 1024)
+        self.chunk_interval = chunk_size / rate
+        self.process = ctx.Process(
+            target=_worker,
+            args=(
+                self.audio_ring.name,
+                self.frame_ring.name,
+                self.stop_event,
+                self.frames_done,
+                self.controls,
+                self.cpu_seconds,
+                self.error,
+                mic_device_index,
+                rate,
+                chunk_size,
+            ),
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self.process.start()
+
+    def set_frame_params(
+        self,
+        max_size: int,
+        quality: int,
+        interval: Optional[float] = None,
+        paused: Optional[bool] = None,
+    ) -> None:
+        # 止めるときは、サイズを変える前に止める
+        if paused is not None and paused:
+            self.controls["paused"].value = True
+        self.controls["max_size"].value = max_size
+        self.controls["quality"].value = quality
+        if interval is not None:
+            self.controls["interval"].value = interval
+        if paused is not None and not paused:
+            self.controls["paused"].value = False
+
+    async def _poll(
+        self, ring: ShmRing, interval: float, done=None
+    ) -> AsyncIterator[bytes]:
+        # 起動前から溜まっていた分は捨てて、最新から読む
+        seq = ring.latest
+        while (
+            self.process.is_alive() and not (done and done.is_set())
+        ) or ring.latest > seq:
+            item = ring.read(seq)
+            if item is None:
+                await asyncio.sleep(interval)
+                continue
+            seq, data = item
+            yield data
+        if done and done.is_set():
+            return
+        if not self.stop_event.is_set() or self.process.exitcode:
+            reason = self.error.value.decode(errors="replace") or "no details"
+            raise RuntimeError(
+                f"Capture process exited with code {self.process.exitcode}: {reason}"
+            )
+
+    def audio_chunks(self) -> AsyncIterator[bytes]:
+        return self._poll(self.audio_ring, self.chunk_interval / 4)
+
+    def frames(self) -> AsyncIterator[bytes]:
+        # フレームのスレッドだけが終わったときは、例外にせずに終わる
+        return self._poll(self.frame_ring, 0.1, self.frames_done)
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.audio_ring.close()
+        self.frame_ring.close()
@@ -9,5 +9,21 @@ class Config(BaseSettings):
     cloud_storage_bucket: str
     service_account_key_path: str
 
+    # 長いターンを無音位置で区切って並列に文字起こしする
+    stt_segment_max_sec: float = 15.0
+    stt_fan_out: int = 4
+
+    # Live sessionへの上り(音声+フレーム)の目標ビットレート
+    upstream_target_kbps: int = 512
+
+    # 無音の間はLive sessionへ音声を送らない
+    dtx_enabled: bool = False
+
+    # マイク・カメラのキャプチャとエンコードを別プロセスで行う
+    capture_process: bool = False
+
+    # 負荷が高い間、文字起こしを後回しにするバックログの保存先
+    stt_backlog_path: str = "stt_backlog.jsonl"
+
 
 config = Config()
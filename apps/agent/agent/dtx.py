@@ -0,0 +1,101 @@
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class SilenceGate:
+    """無音の間は上りの音声チャンクを止める(DTX: discontinuous transmission)
+
+    発話が始まったら直前のpre_roll_sec分を先に送り、語頭が欠けないようにする。
+    発話の終わりからhangover_sec分は送り続け、サーバー側でターンの終了を検知させる。
+    無音が続く間もkeepalive_interval秒ごとに1チャンクだけ送る。
+    enabled=Falseのときはすべて送るが、比較のために統計は取る。
+    """
+
+    def __init__(
+        self,
+        chunk_sec: float,
+        enabled: bool = True,
+        pre_roll_sec: float = 0.3,
+        hangover_sec: float = 1.0,
+        keepalive_interval: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.enabled = enabled
+        self.hangover_chunks = round(hangover_sec / chunk_sec)
+        self.keepalive_interval = keepalive_interval
+        self.clock = clock
+
+        pre_roll_chunks = max(1, round(pre_roll_sec / chunk_sec))
+        self._pre_roll: deque[bytes] = deque(maxlen=pre_roll_chunks)
+        self._silent_chunks = self.hangover_chunks + 1  # 無音から始める
+        self._last_sent_at = clock()
+
+        self.sent_bytes = 0
+        self.sent_chunks = 0
+        self.suppressed_bytes = 0
+        self.suppressed_chunks = 0
+        self.last_speech_at: Optional[float] = None
+        self.response_latencies: list[float] = []
+
+    def process(self, chunk: bytes, is_speech: bool) -> list[bytes]:
+        """送るべきチャンクを、送る順に返す"""
+        now = self.clock()
+        if is_speech:
+            self.last_speech_at = now
+            self._silent_chunks = 0
+        else:
+            self._silent_chunks += 1
+
+        if not self.enabled:
+            return self._send([chunk], now)
+
+        if is_speech:
+            # 無音中に溜めていたプリロールを先に流す
+            chunks = [*self._pre_roll, chunk]
+            self._pre_roll.clear()
+            return self._send(chunks, now)
+
+        if self._silent_chunks <= self.hangover_chunks:
+            return self._send([chunk], now)
+
+        if now - self._last_sent_at >= self.keepalive_interval:
+            # キープアライブより古いチャンクを後からプリロールとして送らないよう捨てる
+            for old in self._pre_roll:
+                self._suppress(old)
+            self._pre_roll.clear()
+            return self._send([chunk], now)
+
+        if len(self._pre_roll) == self._pre_roll.maxlen:
+            self._suppress(self._pre_roll[0])
+        self._pre_roll.append(chunk)
+        return []
+
+    def record_response(self) -> None:
+        """システムの応答音声が届き始めたときに呼び、発話終了からの遅延を記録する"""
+        if self.last_speech_at is not None:
+            self.response_latencies.append(self.clock() - self.last_speech_at)
+            self.last_speech_at = None
+
+    def report(self) -> str:
+        total = self.sent_bytes + self.suppressed_bytes
+        saved = self.suppressed_bytes / total * 100 if total else 0.0
+        latency = "n/a"
+        if self.response_latencies:
+            ordered = sorted(self.response_latencies)
+            latency = f"p50={ordered[len(ordered) // 2]:.2f}s"
+        return (
+            f"[dtx] enabled={self.enabled} sent={self.sent_bytes / 1024:.0f}KiB"
+            f" in {self.sent_chunks} sends, suppressed={saved:.0f}%,"
+            f" response latency {latency} (n={len(self.response_latencies)})"
+        )
+
+    def _send(self, chunks: list[bytes], now: float) -> list[bytes]:
+        self.sent_chunks += len(chunks)
+        self.sent_bytes += sum(len(chunk) for chunk in chunks)
+        self._last_sent_at = now
+        return chunks
+
+    def _suppress(self, chunk: bytes) -> None:
+        self.suppressed_chunks += 1
+        self.suppressed_bytes += len(chunk)
@@ -0,0 +1,262 @@
+"""会話アーカイブを分析用のParquetに書き出す
+
+messagesテーブルを(sentAt, id)のキーセットページングで読み、日付と話者で
+パーティション分けしたParquetに書き出す。前回どこまで書き出したかは
+出力先の_watermark.jsonに残すので、2回目以降は差分だけを書き出す。
+音声の長さ・RMS・発話率は、バケットのWAVを並列数を絞ってダウンロードして求める。
+書き出しにはpyarrowを使う(エージェント本体の依存には含めず、exportのextraにしている)。
+
+    uv sync --extra export
+    python -m agent.export --out exports
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import unquote, urlparse
+
+import numpy as np
+
+from agent.audio import SILENCE_THRESHOLD, wav_to_pcm
+
+if TYPE_CHECKING:
+    from prisma.models import Message
+
+WATERMARK_FILE = "_watermark.json"
+# 発話率を求めるときのフレーム長
+FRAME_MS = 20
+
+
+@dataclass
+class AudioFeatures:
+    duration_sec: float
+    rms: float
+    speech_ratio: float  # 平均振幅がSILENCE_THRESHOLD以上のフレームの割合
+
+
+def audio_features(wav_bytes: bytes) -> AudioFeatures:
+    pcm, sample_rate = wav_to_pcm(wav_bytes)
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    if not len(samples):
+        return AudioFeatures(duration_sec=0.0, rms=0.0, speech_ratio=0.0)
+
+    frame_size = sample_rate * FRAME_MS // 1000
+    frames = samples[: len(samples) // frame_size * frame_size].reshape(-1, frame_size)
+    speech_ratio = 0.0
+    if len(frames):
+        amplitudes = np.abs(frames.astype(np.int32)).mean(axis=1)
+        speech_ratio = float((amplitudes >= SILENCE_THRESHOLD).mean())
+    return AudioFeatures(
+        duration_sec=len(samples) / sample_rate,
+        rms=float(np.sqrt(np.mean(samples.astype(np.float64) ** 2))),
+        speech_ratio=speech_ratio,
+    )
+
+
+def blob_name(content_url: str) -> str:
+    # contentURLはblob.public_url(https://storage.googleapis.com/<bucket>/<name>)
+    return unquote(urlparse(content_url).path.split("/", 2)[-1])
+
+
+@dataclass
+class Watermark:
+    sent_at: datetime
+    id: str
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["Watermark"]:
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        return cls(sent_at=datetime.fromisoformat(data["sentAt"]), id=data["id"])
+
+    def save(self, path: Path) -> None:
+        # 書き込み途中で落ちても壊れないよう、一時ファイルから置き換える
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps({"sentAt": self.sent_at.isoformat(), "id": self.id})
+        )
+        os.replace(tmp_path, path)
+
+
+async def fetch_batch(
+    after: Optional[Watermark], until: datetime, batch_size: int
+) -> list["Message"]:
+    """afterより後の(sentAt, id)順のメッセージを最大batch_size件取得する"""
+    from prisma.models import Message
+
+    where = {"sentAt": {"lte": until}}
+    if after:
+        where["OR"] = [
+            {"sentAt": {"gt": after.sent_at}},
+            {"sentAt": after.sent_at, "id": {"gt": after.id}},
+        ]
+    return await Message.prisma().find_many(
+        where=where,
+        take=batch_size,
+        order=[{"sentAt": "asc"}, {"id": "asc"}],
+    )
+
+
+class AudioFetcher:
+    """WAVのダウンロードと特徴量の計算を、並列数を絞って行う
+
+    同時に持つWAVはconcurrency件までなので、バッチの大きさに関わらず
+    メモリ使用量は一定に収まる。
+    """
+
+    def __init__(self, concurrency: int = 8) -> None:
+        from agent.storage import get_bucket
+
+        self.bucket = get_bucket()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.failed = 0
+
+    async def features(self, message: "Message") -> Optional[AudioFeatures]:
+        async with self.semaphore:
+            try:
+                blob = self.bucket.blob(blob_name(message.contentURL))
+                wav_bytes = await asyncio.to_thread(blob.download_as_bytes)
+                return await asyncio.to_thread(audio_features, wav_bytes)
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed to fetch audio for {message.id}: {e}")
+                return None
+
+
+def write_batch(out: Path, messages: list["Message"], features: list) -> int:
+    """date=YYYY-MM-DD/speaker=XXX/のパーティションごとにParquetを書き出す"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("id", pa.string()),
+            ("sent_at", pa.timestamp("us", tz="UTC")),
+            ("transcript", pa.string()),
+            ("transcript_chars", pa.int32()),
+            ("content_url", pa.string()),
+            ("duration_sec", pa.float64()),
+            ("rms", pa.float64()),
+            ("speech_ratio", pa.float64()),
+        ]
+    )
+
+    partitions: dict[tuple[str, str], list[int]] = {}
+    for i, message in enumerate(messages):
+        date = message.sentAt.astimezone(timezone.utc).date().isoformat()
+        # SpeakerTypeはEnumなので、値の文字列でパーティションを切る
+        speaker = getattr(message.speaker, "value", message.speaker)
+        partitions.setdefault((date, speaker), []).append(i)
+
+    for (date, speaker), rows in partitions.items():
+        columns = {
+            "id": [messages[i].id for i in rows],
+            "sent_at": [messages[i].sentAt for i in rows],
+            "transcript": [messages[i].contentTranscript for i in rows],
+            "transcript_chars": [
+                len(messages[i].contentTranscript or "") for i in rows
+            ],
+            "content_url": [messages[i].contentURL for i in rows],
+        }
+        for name in ("duration_sec", "rms", "speech_ratio"):
+            columns[name] = [
+                getattr(features[i], name) if features[i] else None for i in rows
+            ]
+
+        directory = out / f"date={date}" / f"speaker={speaker}"
+        directory.mkdir(parents=True, exist_ok=True)
+        # バッチの先頭のidをファイル名にして、再実行しても同じファイルを上書きする
+        path = directory / f"part-{messages[rows[0]].id}.parquet"
+        pq.write_table(pa.Table.from_pydict(columns, schema=schema), path)
+    return len(partitions)
+
+
+async def export(
+    out: Path,
+    batch_size: int = 5_000,
+    concurrency: int = 8,
+    with_audio: bool = True,
+    settle: timedelta = timedelta(minutes=1),
+    full: bool = False,
+) -> int:
+    """outにParquetを書き出し、書き出した件数を返す
+
+    直近settleの間に作られたメッセージは、コミット順と時刻順が前後しうるので
+    次回に回す。後から文字起こしが入ったメッセージを反映するには、full=Trueで
+    別の出力先に書き出し直す。
+    """
+    out.mkdir(parents=True, exist_ok=True)
+    watermark_path = out / WATERMARK_FILE
+    watermark = None if full else Watermark.load(watermark_path)
+    until = datetime.now(timezone.utc) - settle
+    fetcher = AudioFetcher(concurrency) if with_audio else None
+
+    started = time.perf_counter()
+    rows = 0
+    files = 0
+    # 書き出している間に、次のバッチを読み込んでおく
+    next_batch = asyncio.create_task(fetch_batch(watermark, until, batch_size))
+    while True:
+        messages = await next_batch
+        if not messages:
+            break
+        watermark = Watermark(sent_at=messages[-1].sentAt, id=messages[-1].id)
+        if len(messages) == batch_size:
+            next_batch = asyncio.create_task(fetch_batch(watermark, until, batch_size))
+        else:
+            next_batch = asyncio.create_task(asyncio.sleep(0, result=[]))
+
+        if fetcher:
+            features = await asyncio.gather(*map(fetcher.features, messages))
+        else:
+            features = [None] * len(messages)
+        files += await asyncio.to_thread(write_batch, out, messages, features)
+        watermark.save(watermark_path)
+
+        rows += len(messages)
+        elapsed = time.perf_counter() - started
+        print(f"[export] {rows} rows, {files} files, {rows / elapsed:,.0f} rows/s")
+
+    elapsed = time.perf_counter() - started
+    failed = f", {fetcher.failed} audio failures" if fetcher else ""
+    print(
+        f"[export] done: {rows} rows in {elapsed:.1f}s"
+        f" ({rows / max(elapsed, 1e-9):,.0f} rows/s){failed}"
+    )
+    return rows
+
+
+async def main() -> None:
+    from prisma import Prisma
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=Path, required=True)
+    parser.add_argument("--batch-size", type=int, default=5_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-audio", action="store_true")
+    parser.add_argument("--full", action="store_true", help="ignore the watermark")
+    args = parser.parse_args()
+
+    prisma = Prisma(auto_register=True)
+    await prisma.connect()
+    try:
+        await export(
+            args.out,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            with_audio=not args.no_audio,
+            full=args.full,
+        )
+    finally:
+        await prisma.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
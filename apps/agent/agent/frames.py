@@ -0,0 +1,66 @@
+import io
+
+import cv2
+import PIL.Image
+
+
+def encode_frame(frame_rgb, max_size: int = 1024, quality: int = 75) -> bytes:
+    """RGBフレームを長辺max_size以内に縮小し、JPEGにエンコードします。"""
+    img = PIL.Image.fromarray(frame_rgb)  # Now using RGB frame
+    img.thumbnail([max_size, max_size])
+
+    image_io = io.BytesIO()
+    img.save(image_io, format="jpeg", quality=quality)
+    return image_io.getvalue()
+
+
+def open_picamera():
+    """Picamera2を1080pのXRGB8888で開始します。使えない環境ではNoneを返します。"""
+    try:
+        from libcamera import controls
+        from picamera2 import Picamera2
+
+        picam2 = Picamera2()
+        sensor_modes = picam2.sensor_modes
+        print("=== sensor_modes ===")
+        print(sensor_modes)
+        mode = sensor_modes[0]
+
+        camera_controls = {
+            "AfMode": controls.AfModeEnum.Continuous,
+        }
+        preview_config = picam2.create_preview_configuration(
+            main={
+                "format": "XRGB8888",
+                "size": (1920, 1080),
+            },
+            # buffer_count=4,
+            controls=camera_controls,
+            raw=mode,
+        )
+        picam2.configure(preview_config)
+        config = picam2.camera_configuration()
+        print("=== camera config ===")
+        print(config)
+
+        picam2.start(config=preview_config)
+        picam2.set_controls({"ScalerCrop": mode["crop_limits"]})
+
+        metadata = picam2.capture_metadata()
+        print("=== metadata ===")
+        print(metadata)
+        return picam2
+    except ModuleNotFoundError:
+        print("libcamera or picamera2 is not installed.")
+        return None
+
+
+def to_rgb(frame):
+    """Picamera2のフレームを3チャンネルのRGBに変換します。"""
+    # 画像が3チャンネル以外の場合は3チャンネルに変換する
+    channels = 1 if len(frame.shape) == 2 else frame.shape[2]
+    if channels == 1:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+    if channels == 4:
+        return cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
+    return frame
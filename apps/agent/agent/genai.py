@@ -1,8 +1,13 @@
+from functools import cache
+
 from google import genai
 
 from agent.config import config
 
-genai_client = genai.client.Client(
-    api_key=config.gemini_api_key,
-    http_options={"api_version": "v1alpha"},
-)
+
+@cache
+def get_genai_client() -> genai.Client:
+    return genai.client.Client(
+        api_key=config.gemini_api_key,
+        http_options={"api_version": "v1alpha"},
+    )
@@ -1,16 +1,12 @@
 import asyncio
 import base64
-import io
+import time
 import traceback
 import uuid
 
 import cv2
-import numpy as np
-import PIL.Image
 import pyaudio
-from google.cloud import speech, speech_v2
-from google.oauth2 import service_account
-from prisma import Prisma
+from prisma import Json, Prisma
 from prisma.models import Message, User
 from google.genai.types import (
     LiveConnectConfig,
@@ -19,10 +15,37 @@ from google.genai.types import (
     PrebuiltVoiceConfig,
 )
 
+from agent.audio import (
+    SILENCE_THRESHOLD,
+    TurnAssembler,
+    has_nonzero,
+    is_low_volume,
+    mean_abs_amplitude,
+    pcm_to_wav_bytes,
+    wav_to_pcm,
+)
+from agent.backlog import SttBacklog
+from agent.bandwidth import BandwidthGovernor
+from agent.capture import CaptureProcess, JitterMeter
 from agent.config import config as app_config
-from agent.genai import genai_client
-from agent.speech_to_text import pcm_to_wav_bytes, stt_google, stt_genai
-from agent.storage import bucket
+from agent.dtx import SilenceGate
+from agent.frames import encode_frame, open_picamera, to_rgb
+from agent.notify import MessagePublisher
+from agent.resample import StreamingResampler
+from agent.resources import ResourceGovernor
+from agent.genai import get_genai_client
+from agent.segmenter import (
+    ParallelTranscriber,
+    Segment,
+    SilenceSplitter,
+    join_parts,
+    split_at_silences,
+    transcribe_segments,
+)
+from agent.speech_to_text import build_stt_router
+from agent.stt_router import SttRequest
+from agent.storage import get_bucket
+from agent.upload import StreamingWavUpload
 
 FORMAT = pyaudio.paInt16
 CHANNELS = 1  # monaural
@@ -31,6 +54,16 @@ RECEIVE_SAMPLE_RATE = 24000
 CHUNK_SIZE = 1024
 
 
+def transcript_fields(parts: list[tuple[float, str]]) -> dict:
+    """文字起こしの結果を、Messageの文字起こしとセグメントのカラムに変換する"""
+    return {
+        "contentTranscript": join_parts(parts),
+        "contentSegments": Json(
+            [{"offset": round(offset, 3), "text": text} for offset, text in parts]
+        ),
+    }
+
+
 class AudioLoop:
     def __init__(self, session):
         self.session = session
@@ -45,51 +78,23 @@ class AudioLoop:
         print(self.audio_interface.get_default_input_device_info())
 
         self.is_system_speaking = False
-
-        self.google_credentials = service_account.Credentials.from_service_account_file(
-            app_config.service_account_key_path
+        self.bandwidth = BandwidthGovernor(
+            target_bps=app_config.upstream_target_kbps * 1000
         )
-        self.speech = speech.SpeechAsyncClient(credentials=self.google_credentials)
-        self.speech_v2 = speech_v2.SpeechAsyncClient(
-            credentials=self.google_credentials
+        self.dtx = SilenceGate(
+            chunk_sec=CHUNK_SIZE / SEND_SAMPLE_RATE, enabled=app_config.dtx_enabled
         )
 
-        try:
-            from libcamera import controls
-            from picamera2 import Picamera2
-
-            self.picam2 = Picamera2()
-            sensor_modes = self.picam2.sensor_modes
-            print("=== sensor_modes ===")
-            print(sensor_modes)
-            mode = sensor_modes[0]
-
-            camera_controls = {
-                "AfMode": controls.AfModeEnum.Continuous,
-            }
-            preview_config = self.picam2.create_preview_configuration(
-                main={
-                    "format": "XRGB8888",
-                    "size": (1920, 1080),
-                },
-                # buffer_count=4,
-                controls=camera_controls,
-                raw=mode,
-            )
-            self.picam2.configure(preview_config)
-            config = self.picam2.camera_configuration()
-            print("=== camera config ===")
-            print(config)
+        # CPU負荷・温度に応じて映像を落としたり、文字起こしを後回しにする
+        self.resources = ResourceGovernor()
+        self.stt_backlog = SttBacklog(app_config.stt_backlog_path)
 
-            self.picam2.start(config=preview_config)
-            self.picam2.set_controls({"ScalerCrop": mode["crop_limits"]})
+        self.stt_router = build_stt_router(language_code="ja-JP")
+        self.publisher = MessagePublisher()
 
-            metadata = self.picam2.capture_metadata()
-            print("=== metadata ===")
-            print(metadata)
-        except ModuleNotFoundError:
-            print("libcamera or picamera2 is not installed.")
-            self.picam2 = None
+        # 別プロセスでキャプチャする場合、カメラはワーカー側で開く
+        self.capture = None
+        self.picam2 = None if app_config.capture_process else open_picamera()
 
     async def send_text(self):
         while True:
@@ -100,83 +105,150 @@ class AudioLoop:
 
     async def send_realtime(self):
         while True:
-            msg = await self.out_queue.get()
+            enqueued_at, msg = await self.out_queue.get()
+            started = time.monotonic()
             await self.session.send(input=msg)
+            self.bandwidth.record_send(
+                len(msg["data"]),
+                send_time=time.monotonic() - started,
+                queue_delay=started - enqueued_at,
+            )
 
     async def save_db(self):
-        language_code = "ja-JP"  # a BCP-47 language tag
         while True:
             data = await self.db_queue.get()
             speaker = data["speaker"]
 
-            audio_id = str(uuid.uuid4())
-            blob = bucket.blob(f"{audio_id}.wav")
+            if "upload" in data:
+                # 録音中に分割アップロード・文字起こし済みのターンは、完了を待つだけ
+                # アップロードに失敗した場合はNoneになる
+                blob = await data["upload"]
+                audio_id = data["audio_id"]
+                transcript_task = data["transcript"]
+            else:
+                audio_id = str(uuid.uuid4())
+                blob = get_bucket().blob(f"{audio_id}.wav")
+
+                if speaker == "SYSTEM":
+                    sample_rate = RECEIVE_SAMPLE_RATE
+                elif speaker == "USER":
+                    sample_rate = SEND_SAMPLE_RATE
+                else:
+                    raise ValueError(f"Invalid speaker: {speaker}")
 
-            if speaker == "SYSTEM":
-                wav_bytes = pcm_to_wav_bytes(
-                    data["audio"],
-                    channels=CHANNELS,
-                    sample_rate=RECEIVE_SAMPLE_RATE,
-                    sample_width=2,  # 16bit
-                )
-            elif speaker == "USER":
                 wav_bytes = pcm_to_wav_bytes(
                     data["audio"],
                     channels=CHANNELS,
-                    sample_rate=SEND_SAMPLE_RATE,
+                    sample_rate=sample_rate,
                     sample_width=2,  # 16bit
                 )
-            else:
-                raise ValueError(f"Invalid speaker: {speaker}")
-
-            blob.upload_from_string(wav_bytes, content_type="audio/wav")
-
-            # stt_google()が使えないので直接書く
-            speech_config = speech_v2.types.cloud_speech.RecognitionConfig(
-                auto_decoding_config=speech_v2.types.AutoDetectDecodingConfig(),
-                language_codes=[language_code],
-                model="latest_long",
-            )
-            request = speech_v2.types.cloud_speech.RecognizeRequest(
-                recognizer=f"projects/{self.google_credentials.project_id}/locations/global/recognizers/_",
-                config=speech_config,
-                content=wav_bytes,
-            )
-            response = await self.speech_v2.recognize(request=request)
-            transcript = ""
-            for result in response.results:
-                transcript += result.alternatives[0].transcript
-            # transcript = await stt_google(
-            #     storage_uri=f"gs://{app_config.cloud_storage_bucket}/{blob.name}",
-            #     sample_rate=sample_rate,
-            #     language_code=language_code,
-            # )
-            # transcript = await stt_genai(audio_bytes=wav_bytes)
-
-            await Message.prisma().create(
+                try:
+                    await asyncio.to_thread(
+                        blob.upload_from_string, wav_bytes, content_type="audio/wav"
+                    )
+                except Exception as e:
+                    print(f"Failed to upload {audio_id}: {e}")
+                    blob = None
+                transcript_task = None
+                # 音声を残せなかったときは後から文字起こしできないので、今行う
+                if not self.resources.settings.defer_stt or blob is None:
+                    transcript_task = self.transcribe_pcm(data["audio"], sample_rate)
+
+            transcript = {"contentTranscript": None}
+            if transcript_task is not None:
+                try:
+                    transcript = transcript_fields(await transcript_task)
+                except Exception as e:
+                    print(f"Failed to transcribe {audio_id}: {e}")
+
+            message = await Message.prisma().create(
                 {
                     "id": audio_id,
-                    "contentURL": blob.public_url,
-                    "contentTranscript": transcript,
+                    "contentURL": blob.public_url if blob else "",
+                    **transcript,
                     "speaker": speaker,
                 }
             )
+            if transcript_task is None and blob:
+                self.stt_backlog.append(audio_id, blob.name)
+            self.publisher.publish(message)
+
+    async def drain_backlog(self):
+        """負荷が下がったら、後回しにした文字起こしを1件ずつ片付ける"""
+        while True:
+            await asyncio.sleep(1.0)
+            entry = self.stt_backlog.peek()
+            if entry is None or self.resources.settings.defer_stt:
+                continue
+
+            audio_id = entry["audio_id"]
+            try:
+                blob = get_bucket().blob(entry["blob_name"])
+                wav_bytes = await asyncio.to_thread(blob.download_as_bytes)
+                pcm, sample_rate = wav_to_pcm(wav_bytes)
+                parts = await self.transcribe_pcm(pcm, sample_rate)
+                message = await Message.prisma().update(
+                    where={"id": audio_id},
+                    data=transcript_fields(parts),
+                )
+            except Exception as e:
+                print(f"Failed to transcribe backlog {audio_id}: {e}")
+                if not self.stt_backlog.requeue(entry):
+                    print(f"Gave up transcribing {audio_id}")
+                continue
+
+            self.stt_backlog.remove(entry)
+            if message:
+                self.publisher.publish(message)
+            print(f"Transcribed backlog {audio_id} ({len(self.stt_backlog)} left)")
+
+    async def transcribe_pcm(
+        self, pcm: bytes, sample_rate: int
+    ) -> list[tuple[float, str]]:
+        return await transcribe_segments(
+            split_at_silences(
+                pcm,
+                sample_rate,
+                max_segment_sec=app_config.stt_segment_max_sec,
+                min_segment_sec=app_config.stt_segment_max_sec / 3,
+            ),
+            lambda segment: self.transcribe_segment(segment, sample_rate),
+            fan_out=app_config.stt_fan_out,
+        )
+
+    async def transcribe_segment(self, segment: Segment, sample_rate: int) -> str:
+        wav_bytes = pcm_to_wav_bytes(
+            segment.pcm,
+            channels=CHANNELS,
+            sample_rate=sample_rate,
+            sample_width=2,  # 16bit
+        )
+        return await self.stt_router.transcribe(
+            SttRequest(sample_rate=sample_rate, audio_bytes=wav_bytes)
+        )
 
     def is_low_volume(self, audio_data: bytes) -> bool:
-        audio_data = np.frombuffer(audio_data, dtype=np.int16)
-        mean_abs_amplitude = np.abs(audio_data).mean()
-        return mean_abs_amplitude < 500
+        return is_low_volume(audio_data)
+
+    async def _mic_chunks(self, mic_device_index):
+        # デバイスのネイティブレートで録音し、SEND_SAMPLE_RATEへは自前で変換する
+        device_info = self.audio_interface.get_device_info_by_index(mic_device_index)
+        capture_rate = int(device_info["defaultSampleRate"])
+        capture_chunk_size = CHUNK_SIZE * capture_rate // SEND_SAMPLE_RATE
+        resampler = None
+        if capture_rate != SEND_SAMPLE_RATE:
+            resampler = StreamingResampler(capture_rate, SEND_SAMPLE_RATE)
+            print(f"Resampling microphone: {capture_rate}Hz -> {SEND_SAMPLE_RATE}Hz")
 
-    async def listen_audio(self, mic_device_index=0):
         self.audio_stream = await asyncio.to_thread(
             self.audio_interface.open,
             format=FORMAT,
             channels=CHANNELS,
-            rate=SEND_SAMPLE_RATE,
+            rate=capture_rate,
             input=True,
             # input_device_index=self.audio_interface.get_default_input_device_info()["index"],
             input_device_index=mic_device_index,
-            frames_per_buffer=CHUNK_SIZE,
+            frames_per_buffer=capture_chunk_size,
         )
 
         if __debug__:
@@ -184,49 +256,79 @@ class AudioLoop:
         else:
             kwargs = {}
 
-        turn_block = b""
-        silent_chunks = 0
         while True:
-            data = await asyncio.to_thread(self.audio_stream.read, CHUNK_SIZE, **kwargs)
+            data = await asyncio.to_thread(
+                self.audio_stream.read, capture_chunk_size, **kwargs
+            )
+            if resampler:
+                data = resampler.process(data)
+            yield data
+
+    async def listen_audio(self, mic_device_index=0):
+        if self.capture:
+            chunks = self.capture.audio_chunks()
+        else:
+            chunks = self._mic_chunks(mic_device_index)
+
+        jitter = JitterMeter(expected_interval=CHUNK_SIZE / SEND_SAMPLE_RATE)
+        turns = TurnAssembler(sample_rate=SEND_SAMPLE_RATE)
+        reported_at = time.monotonic()
+        async for data in chunks:
+            jitter.record()
+            if time.monotonic() - reported_at >= 60:
+                worker_cpu = self.capture.cpu_seconds.value if self.capture else 0.0
+                print(self.dtx.report())
+                print(jitter.report(worker_cpu=worker_cpu))
+                reported_at = time.monotonic()
 
             # Do not interrupt while the system is speaking
             if self.is_system_speaking:
-                if len(turn_block) > 2048:
-                    self.db_queue.put_nowait({"audio": turn_block, "speaker": "USER"})
-                turn_block = b""
+                if turn := turns.flush():
+                    self.db_queue.put_nowait({"audio": turn, "speaker": "USER"})
                 continue
 
-            await self.out_queue.put({"data": data, "mime_type": "audio/pcm"})
-
-            audio_data = np.frombuffer(data, dtype=np.int16)
-            mean_abs_amplitude = np.abs(audio_data).mean()
-
-            turn_block += data
-            if mean_abs_amplitude < 500:
-                silent_chunks += 1
-            else:
-                silent_chunks = 0
-
-            # 一定期間以上の無音区間があれば、ターンの終了判定
-            silent_sample_num = silent_chunks * CHUNK_SIZE * CHANNELS
-            if silent_sample_num >= SEND_SAMPLE_RATE * 3:
-                if len(turn_block) > 2048:
-                    self.db_queue.put_nowait({"audio": turn_block, "speaker": "USER"})
-                turn_block = b""
-
-    def _get_frame(self, frame_rgb):
-        img = PIL.Image.fromarray(frame_rgb)  # Now using RGB frame
-        img.thumbnail([1024, 1024])
+            is_speech = mean_abs_amplitude(data) >= SILENCE_THRESHOLD
+            for chunk in self.dtx.process(data, is_speech):
+                await self.out_queue.put(
+                    (time.monotonic(), {"data": chunk, "mime_type": "audio/pcm"})
+                )
 
-        image_io = io.BytesIO()
-        img.save(image_io, format="jpeg")
-        image_io.seek(0)
+            if turn := turns.feed(data, is_speech):
+                self.db_queue.put_nowait({"audio": turn, "speaker": "USER"})
 
+    def _frame_data(self, image_bytes):
+        # BandwidthGovernorはスレッドセーフではないので、イベントループのスレッドで呼ぶ
         mime_type = "image/jpeg"
-        image_bytes = image_io.read()
+        self.bandwidth.record_frame(len(image_bytes))
         return {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}
 
+    def _frame_params(self):
+        quality = self.bandwidth.current
+        max_size = quality.max_size
+        settings = self.resources.settings
+        if settings.video_enabled:
+            max_size = min(max_size, settings.frame_max_size)
+        return {"max_size": max_size, "quality": quality.quality}
+
+    async def update_capture_params(self):
+        # 映像を止めている間はフレームが届かないので、フレームとは別に反映する
+        while True:
+            settings = self.resources.settings
+            self.capture.set_frame_params(
+                **self._frame_params(),
+                interval=settings.frame_interval,
+                paused=not settings.video_enabled,
+            )
+            await asyncio.sleep(1.0)
+
     async def get_frames(self):
+        if self.capture:
+            # エンコード済みのJPEGがワーカーから届くので、送るだけ
+            async for image_bytes in self.capture.frames():
+                frame_data = self._frame_data(image_bytes)
+                await self.out_queue.put((time.monotonic(), frame_data))
+            return
+
         if not self.picam2:
             # This takes about a second, and will block the whole program
             # causing the audio pipeline to overflow if you don't to_thread it.
@@ -239,15 +341,17 @@ class AudioLoop:
             cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc("M", "J", "P", "G"))
 
         while True:
+            settings = self.resources.settings
+            if not settings.video_enabled:
+                await asyncio.sleep(settings.frame_interval)
+                continue
+
             if self.picam2:
                 frame = self.picam2.capture_array()
-                # 画像が3チャンネル以外の場合は3チャンネルに変換する
-                channels = 1 if len(frame.shape) == 2 else frame.shape[2]
-                if channels == 1:
-                    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
-                if channels == 4:
-                    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
-                frame_data = await asyncio.to_thread(self._get_frame, frame_rgb)
+                frame_rgb = to_rgb(frame)
+                image_bytes = await asyncio.to_thread(
+                    encode_frame, frame_rgb, **self._frame_params()
+                )
             else:
                 ret, frame = cap.read()
                 if not ret:
@@ -256,11 +360,15 @@ class AudioLoop:
                 # OpenCV captures in BGR but PIL expects RGB format
                 # This prevents the blue tint in the video feed
                 frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame_data = await asyncio.to_thread(self._get_frame, frame_rgb)
+                image_bytes = await asyncio.to_thread(
+                    encode_frame, frame_rgb, **self._frame_params()
+                )
 
-            await asyncio.sleep(2.0)
+            frame_data = self._frame_data(image_bytes)
 
-            await self.out_queue.put(frame_data)
+            await asyncio.sleep(settings.frame_interval)
+
+            await self.out_queue.put((time.monotonic(), frame_data))
 
         # Release the VideoCapture object
         cap.release()
@@ -269,11 +377,42 @@ class AudioLoop:
         "Background task to reads from the websocket and write pcm chunks to the output queue"
         while True:
             turn = self.session.receive()
-            turn_block = b""
+            audio_id = str(uuid.uuid4())
+            upload = None
+            nonzero = False
+            # 保存と文字起こしは、ユーザーの音声と同じSEND_SAMPLE_RATEに揃える
+            resampler = StreamingResampler(RECEIVE_SAMPLE_RATE, SEND_SAMPLE_RATE)
+            # 受信しながら無音位置で区切り、区切れたセグメントから文字起こしを始める
+            # 負荷が高いときはアップロードだけ行い、文字起こしはバックログに回す
+            defer_stt = self.resources.settings.defer_stt
+            splitter = SilenceSplitter(
+                SEND_SAMPLE_RATE,
+                max_segment_sec=app_config.stt_segment_max_sec,
+                min_segment_sec=app_config.stt_segment_max_sec / 3,
+            )
+            transcriber = ParallelTranscriber(
+                lambda segment: self.transcribe_segment(segment, SEND_SAMPLE_RATE),
+                fan_out=app_config.stt_fan_out,
+            )
             async for response in turn:
                 if data := response.data:
+                    if not self.is_system_speaking:
+                        self.dtx.record_response()
                     self.audio_in_queue.put_nowait(data)
-                    turn_block += data
+                    # ターン全体をメモリに溜めず、パート単位でアップロードする
+                    if upload is None:
+                        upload = StreamingWavUpload(
+                            f"{audio_id}.wav",
+                            sample_rate=SEND_SAMPLE_RATE,
+                            channels=CHANNELS,
+                            sample_width=2,  # 16bit
+                        )
+                    archived = resampler.process(data)
+                    upload.write(archived)
+                    if not defer_stt:
+                        for segment in splitter.feed(archived):
+                            transcriber.submit(segment)
+                    nonzero = nonzero or has_nonzero(data)
                     self.is_system_speaking = True
                 if text := response.text:
                     print(text, end="")
@@ -285,9 +424,25 @@ class AudioLoop:
             # while not self.audio_in_queue.empty():
             #     self.audio_in_queue.get_nowait()
 
-            has_nonzero = any(b != 0 for b in turn_block)
-            if has_nonzero:
-                self.db_queue.put_nowait({"audio": turn_block, "speaker": "SYSTEM"})
+            if upload:
+                if nonzero:
+                    transcript_task = None
+                    if not defer_stt:
+                        for segment in splitter.flush():
+                            transcriber.submit(segment)
+                        transcript_task = asyncio.create_task(transcriber.parts())
+                    # 合成と残りの文字起こしは次のターンの受信と並行して進める
+                    self.db_queue.put_nowait(
+                        {
+                            "audio_id": audio_id,
+                            "upload": asyncio.create_task(upload.close()),
+                            "transcript": transcript_task,
+                            "speaker": "SYSTEM",
+                        }
+                    )
+                else:
+                    transcriber.cancel()
+                    await upload.abort()
 
             self.is_system_speaking = False
 
@@ -312,7 +467,6 @@ class AudioLoop:
                 self.db_queue = asyncio.Queue()
 
                 send_text_task = tg.create_task(self.send_text())
-                tg.create_task(self.get_frames())
 
                 print("Available input devices:")
                 for i in range(self.audio_interface.get_device_count()):
@@ -324,10 +478,20 @@ class AudioLoop:
                         "Please enter the user's microphone input device number (User's speech + system sound mixed): ",
                     )
                 )
+                if app_config.capture_process:
+                    self.capture = CaptureProcess(
+                        mic_device_index, rate=SEND_SAMPLE_RATE, chunk_size=CHUNK_SIZE
+                    )
+                    self.capture.start()
+                    tg.create_task(self.update_capture_params())
+                tg.create_task(self.resources.run())
+                tg.create_task(self.get_frames())
                 tg.create_task(self.listen_audio(mic_device_index))
 
                 tg.create_task(self.send_realtime())
                 tg.create_task(self.save_db())
+                tg.create_task(self.drain_backlog())
+                tg.create_task(self.publisher.run())
 
                 tg.create_task(self.receive_audio())
                 tg.create_task(self.play_audio())
@@ -337,14 +501,18 @@ class AudioLoop:
         except asyncio.CancelledError:
             pass
         except ExceptionGroup as EG:
-            self.audio_stream.close()
+            if self.audio_stream:
+                self.audio_stream.close()
             if self.picam2:
                 self.picam2.stop()
             traceback.print_exception(EG)
+        finally:
+            if self.capture:
+                self.capture.close()
 
 
 async def main():
-    # available_models = await genai_client.aio.models.list(config={"page_size": 5})
+    # available_models = await get_genai_client().aio.models.list(config={"page_size": 5})
     # print(available_models.page)
 
     prisma = Prisma(auto_register=True)
@@ -384,7 +552,7 @@ Furthermore, if the received audio contains significant noise and cannot be clea
             ),
         )
 
-        async with genai_client.aio.live.connect(
+        async with get_genai_client().aio.live.connect(
             model=model_id, config=config
         ) as session:
             await AudioLoop(session).run()
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import time
+from typing import TYPE_CHECKING
+
+from prisma import get_client
+
+if TYPE_CHECKING:
+    from prisma.models import Message
+
+# Postgres側でLISTENするチャンネル名
+CHANNEL = "messages"
+# NOTIFYのペイロードは8000バイトまでなので、文字起こしは先頭だけ載せる
+SNIPPET_LENGTH = 200
+
+
+def message_payload(message: "Message") -> str:
+    return json.dumps(
+        {
+            "id": message.id,
+            "speaker": message.speaker,
+            "snippet": (message.contentTranscript or "")[:SNIPPET_LENGTH],
+            "sentAt": message.sentAt.isoformat(),
+            # 受信側で配信遅延を計測するための送信時刻(UNIX秒)
+            "publishedAt": time.time(),
+        },
+        ensure_ascii=False,
+    )
+
+
+class MessagePublisher:
+    """保存したMessageをpg_notifyで通知する
+
+    save_dbを待たせないよう、publish()はキューに積むだけで、送信はrun()が行う。
+    キューがあふれたら古い通知から捨てる(受信側は再取得で追いつける)。
+    """
+
+    def __init__(self, channel: str = CHANNEL, maxsize: int = 100) -> None:
+        self.channel = channel
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=maxsize)
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def publish(self, message: "Message") -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message_payload(message))
+
+    async def run(self) -> None:
+        client = get_client()
+        while True:
+            payload = await self.queue.get()
+            try:
+                await client.query_raw("SELECT pg_notify($1, $2)", self.channel, payload)
+                self.published += 1
+            except Exception as e:
+                # 通知に失敗しても保存済みのデータには影響しないので、続行する
+                self.failed += 1
+                print(f"Failed to notify {self.channel}: {e}")
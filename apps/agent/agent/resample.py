@@ -0,0 +1,72 @@
+from math import ceil, gcd
+
+import numpy as np
+
+
+def design_filter(up: int, down: int, taps_per_phase: int, beta: float) -> np.ndarray:
+    """Kaiser窓付きsincのローパスを(up, taps_per_phase)のポリフェーズ係数に分解する"""
+    num_taps = up * taps_per_phase
+    # 変換後のナイキスト周波数の手前で落とす(アップサンプル後のレート基準)
+    cutoff = 0.92 / max(up, down)
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    h = cutoff * np.sinc(cutoff * n) * np.kaiser(num_taps, beta)
+    # 各位相でDCゲインが1になるよう正規化する
+    h *= up / h.sum()
+    # phases[p, k] = h[p + k * up]
+    return h.reshape(taps_per_phase, up).T.astype(np.float32)
+
+
+class StreamingResampler:
+    """16bit PCMをチャンク単位でリサンプリングするポリフェーズフィルタ
+
+    チャンクの境界をまたいで入力の履歴と出力の位相を保持するので、
+    任意の長さのチャンクを続けて渡しても一括変換と同じ結果になる。
+    """
+
+    def __init__(
+        self,
+        in_rate: int,
+        out_rate: int,
+        zero_crossings: int = 16,
+        beta: float = 8.0,
+    ) -> None:
+        divisor = gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        # ダウンサンプリングではカットオフが下がる分だけフィルタを長くする
+        self.taps = ceil(2 * zero_crossings * max(self.up, self.down) / self.up)
+        self.phases = design_filter(self.up, self.down, self.taps, beta)
+
+        # 直前のチャンクの末尾(taps - 1サンプル)
+        self._history = np.zeros(self.taps - 1, dtype=np.float32)
+        self._consumed = 0  # これまでに受け取った入力サンプル数
+        self._produced = 0  # これまでに出力したサンプル数
+
+    def process(self, pcm: bytes) -> bytes:
+        x = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        buffer = np.concatenate([self._history, x])
+        total = self._consumed + len(x)
+
+        # 出力n番目は、アップサンプル後の位置n * downに対応する
+        # 入力index = n * down // up、位相 = n * down % up
+        end = (total * self.up + self.down - 1) // self.down
+        n = np.arange(self._produced, end, dtype=np.int64)
+        position = n * self.down
+        index = position // self.up - (self._consumed - len(self._history))
+        phase = position % self.up
+
+        windows = buffer[index[:, None] - np.arange(self.taps)[None, :]]
+        y = np.einsum("ij,ij->i", windows, self.phases[phase])
+
+        self._history = buffer[len(buffer) - (self.taps - 1) :]
+        self._consumed = total
+        self._produced = end
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16).tobytes()
+
+
+def resample(pcm: bytes, in_rate: int, out_rate: int, **kwargs) -> bytes:
+    if in_rate == out_rate:
+        return pcm
+    return StreamingResampler(in_rate, out_rate, **kwargs).process(pcm)
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Callable, Optional
+
+THERMAL_ZONE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+class Mode(IntEnum):
+    NORMAL = 0
+    REDUCED_VIDEO = 1  # カメラの解像度と送信間隔を落とす
+    DEFER_STT = 2  # 文字起こしをディスク上のバックログに回す
+    NO_VIDEO = 3  # 映像を止める
+
+
+@dataclass(frozen=True)
+class ModeSettings:
+    frame_max_size: int
+    frame_interval: float
+    video_enabled: bool
+    defer_stt: bool
+
+
+MODE_SETTINGS = {
+    Mode.NORMAL: ModeSettings(1024, 2.0, True, False),
+    Mode.REDUCED_VIDEO: ModeSettings(512, 4.0, True, False),
+    Mode.DEFER_STT: ModeSettings(384, 6.0, True, True),
+    Mode.NO_VIDEO: ModeSettings(0, 6.0, False, True),
+}
+
+
+@dataclass
+class Reading:
+    cpu_load: float  # 0.0〜1.0
+    loop_lag: float  # イベントループの遅れ(秒)
+    temperature: Optional[float] = None  # SoCの温度(℃)、取れない環境ではNone
+
+
+@dataclass(frozen=True)
+class Thresholds:
+    """各モードに入るしきい値(REDUCED_VIDEO, DEFER_STT, NO_VIDEOの順)"""
+
+    cpu_load: tuple[float, float, float] = (0.75, 0.85, 0.95)
+    loop_lag: tuple[float, float, float] = (0.05, 0.15, 0.5)
+    temperature: tuple[float, float, float] = (70.0, 75.0, 80.0)
+    # 抜けるときはしきい値からこれだけ下がっている必要がある
+    cpu_load_margin: float = 0.1
+    loop_lag_margin: float = 0.03
+    temperature_margin: float = 5.0
+
+
+def _level(value: Optional[float], thresholds: tuple, margin: float = 0.0) -> int:
+    if value is None:
+        return 0
+    return sum(1 for threshold in thresholds if value >= threshold - margin)
+
+
+class ResourceGovernor:
+    """CPU負荷・イベントループの遅れ・温度からモードを決める
+
+    悪化したときはすぐに必要なモードまで下げ、回復したときは
+    ヒステリシスのマージンを下回った状態がmin_dwell秒続いてから1段ずつ戻す。
+    """
+
+    def __init__(
+        self,
+        thresholds: Thresholds = Thresholds(),
+        min_dwell: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.thresholds = thresholds
+        self.min_dwell = min_dwell
+        self.clock = clock
+        self.mode = Mode.NORMAL
+        self._calm_since: Optional[float] = None
+
+    @property
+    def settings(self) -> ModeSettings:
+        return MODE_SETTINGS[self.mode]
+
+    def _pressure(self, reading: Reading, relaxed: bool) -> int:
+        t = self.thresholds
+        return max(
+            _level(reading.cpu_load, t.cpu_load, t.cpu_load_margin if relaxed else 0),
+            _level(reading.loop_lag, t.loop_lag, t.loop_lag_margin if relaxed else 0),
+            _level(
+                reading.temperature,
+                t.temperature,
+                t.temperature_margin if relaxed else 0,
+            ),
+        )
+
+    def update(self, reading: Reading) -> Mode:
+        now = self.clock()
+        pressure = self._pressure(reading, relaxed=False)
+        if pressure > self.mode:
+            self._change(Mode(pressure), reading)
+            self._calm_since = None
+            return self.mode
+
+        # マージンを含めても今のモードの条件を下回っているか
+        if self._pressure(reading, relaxed=True) < self.mode:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.min_dwell:
+                self._change(Mode(self.mode - 1), reading)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+        return self.mode
+
+    def _change(self, mode: Mode, reading: Reading) -> None:
+        temperature = (
+            "n/a" if reading.temperature is None else f"{reading.temperature:.1f}C"
+        )
+        print(
+            f"[resources] {self.mode.name} -> {mode.name}"
+            f" (cpu={reading.cpu_load * 100:.0f}%, lag={reading.loop_lag * 1000:.0f}ms,"
+            f" temp={temperature})"
+        )
+        self.mode = mode
+
+    async def run(
+        self,
+        interval: float = 2.0,
+        read_cpu_load: Optional[Callable[[], float]] = None,
+        read_temperature: Optional[Callable[[], Optional[float]]] = None,
+    ) -> None:
+        read_cpu_load = read_cpu_load or CpuLoadSensor()
+        read_temperature = read_temperature or read_thermal_zone
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            # 指定した時間より遅れて起きた分が、イベントループの詰まり
+            loop_lag = max(0.0, time.monotonic() - started - interval)
+            self.update(
+                Reading(
+                    cpu_load=read_cpu_load(),
+                    loop_lag=loop_lag,
+                    temperature=read_temperature(),
+                )
+            )
+
+
+class CpuLoadSensor:
+    """/proc/statの差分からCPU使用率を求める。使えない環境ではロードアベレージで代用する"""
+
+    def __init__(self, path: str = "/proc/stat") -> None:
+        self.path = path
+        self._previous: Optional[tuple[int, int]] = None
+
+    def _read(self) -> Optional[tuple[int, int]]:
+        try:
+            with open(self.path) as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        return sum(values), idle
+
+    def __call__(self) -> float:
+        current = self._read()
+        if current is None:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        previous, self._previous = self._previous, current
+        if previous is None or current[0] == previous[0]:
+            return 0.0
+        total = current[0] - previous[0]
+        idle = current[1] - previous[1]
+        return 1.0 - idle / total
+
+
+def read_thermal_zone(path: str = THERMAL_ZONE_PATH) -> Optional[float]:
+    try:
+        with open(path) as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
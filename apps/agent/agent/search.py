@@ -0,0 +1,113 @@
+"""会話の文字起こし検索
+
+messages.content_transcriptに張ったpg_trgmのGIN索引を使って、Postgres側で検索する。
+索引は保存と同時に更新されるので、新しいメッセージもすぐに検索できる。
+索引はスキーマ(apps/web/prisma)で定義しているので、`prisma db push`で作られる。
+
+    python -m agent.search "公園" --days 7
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+
+@dataclass
+class SearchResult:
+    id: str
+    score: float
+    sent_at: datetime
+    transcript: str
+
+
+def like_pattern(query: str) -> str:
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+async def search_messages(
+    query: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = 20,
+) -> list[SearchResult]:
+    """queryを含む、または似た文字列を含む文字起こしを返す
+
+    日本語は単語の区切りがなく、2文字以下のクエリはtrigramが一致しないので、
+    部分一致(ILIKE)を先に並べ、続けてword_similarityが
+    pg_trgm.word_similarity_threshold(既定0.6)以上のものをスコア順に並べる。
+    同点なら新しい順。
+    """
+    from prisma import get_client
+
+    query = query.strip()
+    if not query:
+        return []
+
+    conditions = ["(content_transcript ILIKE $2 OR $1 <% content_transcript)"]
+    args: list = [query, like_pattern(query)]
+    # posted_atはタイムゾーンなしのUTCで保存されている
+    if since is not None:
+        args.append(since.isoformat())
+        conditions.append(f"posted_at >= ${len(args)}::timestamptz AT TIME ZONE 'UTC'")
+    if until is not None:
+        args.append(until.isoformat())
+        conditions.append(f"posted_at <= ${len(args)}::timestamptz AT TIME ZONE 'UTC'")
+    args.append(limit)
+
+    rows = await get_client().query_raw(
+        f"""
+        SELECT
+            id,
+            posted_at AT TIME ZONE 'UTC' AS sent_at,
+            content_transcript AS transcript,
+            GREATEST(
+                similarity(content_transcript, $1),
+                word_similarity($1, content_transcript)
+            ) AS score
+        FROM messages
+        WHERE {" AND ".join(conditions)}
+        ORDER BY content_transcript ILIKE $2 DESC, score DESC, posted_at DESC
+        LIMIT ${len(args)}
+        """,
+        *args,
+    )
+    return [
+        SearchResult(
+            id=row["id"],
+            score=float(row["score"]),
+            sent_at=row["sent_at"],
+            transcript=row["transcript"],
+        )
+        for row in rows
+    ]
+
+
+async def main() -> None:
+    from prisma import Prisma
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("query")
+    parser.add_argument("--days", type=float, help="直近の日数に絞り込む")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    since = None
+    if args.days is not None:
+        since = datetime.now(timezone.utc) - timedelta(days=args.days)
+
+    prisma = Prisma(auto_register=True)
+    await prisma.connect()
+    try:
+        results = await search_messages(args.query, since=since, limit=args.limit)
+    finally:
+        await prisma.disconnect()
+
+    for result in results:
+        print(f"{result.score:.2f} {result.sent_at:%Y-%m-%d %H:%M} {result.transcript}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable
+
+import numpy as np
+
+
+@dataclass
+class Segment:
+    offset: float  # ターン先頭からの開始時刻(秒)
+    pcm: bytes
+
+
+class SilenceSplitter:
+    """16bit PCMを、上限の長さ以内で最も音量の小さい位置で区切っていく
+
+    feed()で受け取ったPCMが上限に達するたびに、[min_segment_sec, max_segment_sec]
+    の範囲で最もエネルギーの低いフレーム境界を探して区切る。
+    保持するのは最大でmax_segment_sec分のPCMのみ。
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        max_segment_sec: float = 15.0,
+        min_segment_sec: float = 5.0,
+        frame_ms: int = 20,
+        channels: int = 1,
+        sample_width: int = 2,
+    ) -> None:
+        if not 0 < min_segment_sec < max_segment_sec:
+            raise ValueError("Requires 0 < min_segment_sec < max_segment_sec")
+
+        self.sample_rate = sample_rate
+        self.bytes_per_sample = channels * sample_width
+        self.frame_bytes = sample_rate * frame_ms // 1000 * self.bytes_per_sample
+        self.half_frame_bytes = (
+            self.frame_bytes // 2 // self.bytes_per_sample * self.bytes_per_sample
+        )
+        self.max_bytes = self._align(max_segment_sec)
+        self.min_bytes = self._align(min_segment_sec)
+
+        self._buffer = bytearray()
+        self._consumed = 0  # 切り出し済みのバイト数
+
+    def _align(self, seconds: float) -> int:
+        size = int(seconds * self.sample_rate) * self.bytes_per_sample
+        return size // self.frame_bytes * self.frame_bytes
+
+    def feed(self, pcm: bytes) -> list[Segment]:
+        self._buffer += pcm
+        segments = []
+        while len(self._buffer) >= self.max_bytes:
+            segments.append(self._cut(self._find_cut()))
+        return segments
+
+    def flush(self) -> list[Segment]:
+        if not self._buffer:
+            return []
+        return [self._cut(len(self._buffer))]
+
+    def _find_cut(self) -> int:
+        window = np.frombuffer(
+            self._buffer, dtype=np.int16, count=self.max_bytes // 2
+        )[self.min_bytes // 2 :]
+        frames = window.reshape(-1, self.frame_bytes // 2).astype(np.float32)
+        energy = np.square(frames).mean(axis=1)
+        # 最も静かなフレームの中央で区切る
+        quietest = int(energy.argmin())
+        return self.min_bytes + quietest * self.frame_bytes + self.half_frame_bytes
+
+    def _cut(self, size: int) -> Segment:
+        offset = self._consumed / self.bytes_per_sample / self.sample_rate
+        segment = Segment(offset=offset, pcm=bytes(self._buffer[:size]))
+        del self._buffer[:size]
+        self._consumed += size
+        return segment
+
+
+def split_at_silences(pcm: bytes, sample_rate: int, **kwargs) -> list[Segment]:
+    splitter = SilenceSplitter(sample_rate, **kwargs)
+    return splitter.feed(pcm) + splitter.flush()
+
+
+class ParallelTranscriber:
+    """セグメントを最大fan_out並列で文字起こしし、元の順序で連結する"""
+
+    def __init__(
+        self, transcribe: Callable[[Segment], Awaitable[str]], fan_out: int = 4
+    ) -> None:
+        self._transcribe = transcribe
+        self._semaphore = asyncio.Semaphore(fan_out)
+        self._tasks: list[tuple[float, asyncio.Task]] = []
+
+    def submit(self, segment: Segment) -> None:
+        task = asyncio.create_task(self._run(segment))
+        self._tasks.append((segment.offset, task))
+
+    async def _run(self, segment: Segment) -> str:
+        async with self._semaphore:
+            return await self._transcribe(segment)
+
+    async def parts(self) -> list[tuple[float, str]]:
+        """(セグメントの開始時刻(秒), テキスト)を元の順序で返す"""
+        tasks = [task for _, task in self._tasks]
+        try:
+            texts = await asyncio.gather(*tasks)
+        except BaseException:
+            # 1つでも失敗したら、残りの文字起こしは無駄になるので止める
+            self.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [(offset, text) for (offset, _), text in zip(self._tasks, texts)]
+
+    async def result(self) -> str:
+        return join_parts(await self.parts())
+
+    def cancel(self) -> None:
+        for _, task in self._tasks:
+            task.cancel()
+
+
+def join_parts(parts: list[tuple[float, str]]) -> str:
+    return "".join(text for _, text in parts)
+
+
+async def transcribe_segments(
+    segments: Iterable[Segment],
+    transcribe: Callable[[Segment], Awaitable[str]],
+    fan_out: int = 4,
+) -> list[tuple[float, str]]:
+    transcriber = ParallelTranscriber(transcribe, fan_out=fan_out)
+    for segment in segments:
+        transcriber.submit(segment)
+    return await transcriber.parts()
@@ -1,5 +1,5 @@
+from functools import cache
 from typing import Optional
-import io
 import queue
 import re
 import sys
@@ -11,18 +11,30 @@ from google.oauth2 import service_account
 from google.genai.types import Part
 
 from agent.config import config
-from agent.genai import genai_client
-from agent.storage import bucket
+from agent.genai import get_genai_client
+from agent.storage import get_bucket
+from agent.stt_router import SttBackend, SttRequest, SttRouter
 
 # Audio recording parameters
 RATE = 16000
 CHUNK = int(RATE / 10)  # 100ms
 
-credentials = service_account.Credentials.from_service_account_file(
-    config.service_account_key_path
-)
-speech_client = speech.SpeechAsyncClient(credentials=credentials)
-speech_v2_client = speech_v2.SpeechAsyncClient(credentials=credentials)
+
+@cache
+def _credentials() -> service_account.Credentials:
+    return service_account.Credentials.from_service_account_file(
+        config.service_account_key_path
+    )
+
+
+@cache
+def _speech_client() -> speech.SpeechAsyncClient:
+    return speech.SpeechAsyncClient(credentials=_credentials())
+
+
+@cache
+def _speech_v2_client() -> speech_v2.SpeechAsyncClient:
+    return speech_v2.SpeechAsyncClient(credentials=_credentials())
 
 
 class MicrophoneStream:
@@ -223,7 +235,7 @@ async def main() -> None:
         print(i, info["name"])
 
     filename = "8afd47b0-9801-4478-b148-0e9d8cae115f.wav"
-    blob = bucket.blob(filename)
+    blob = get_bucket().blob(filename)
     audio_bytes = blob.download_as_bytes()
 
     ##### Speech to Text
@@ -266,7 +278,7 @@ async def stt_google(
         uri=storage_uri,
     )
 
-    response = await speech_client.recognize(config=speech_config, audio=audio)
+    response = await _speech_client().recognize(config=speech_config, audio=audio)
 
     transcript = ""
     for result in response.results:
@@ -275,19 +287,24 @@ async def stt_google(
     return transcript
 
 
-async def stt_google_v2(audio_bytes: Optional[bytes] = None) -> str:
+async def stt_google_v2(
+    language_code: str = "ja-JP",
+    audio_bytes: Optional[bytes] = None,
+    storage_uri: Optional[str] = None,
+) -> str:
     speech_config = speech_v2.types.cloud_speech.RecognitionConfig(
         auto_decoding_config=speech_v2.types.AutoDetectDecodingConfig(),
-        language_codes=["ja-JP"],
+        language_codes=[language_code],
         model="latest_long",
     )
 
     request = speech_v2.types.cloud_speech.RecognizeRequest(
-        recognizer=f"projects/{credentials.project_id}/locations/global/recognizers/_",
+        recognizer=f"projects/{_credentials().project_id}/locations/global/recognizers/_",
         config=speech_config,
         content=audio_bytes,
+        uri=storage_uri,
     )
-    response = await speech_v2_client.recognize(request=request)
+    response = await _speech_v2_client().recognize(request=request)
 
     transcript = ""
     for result in response.results:
@@ -306,7 +323,7 @@ async def stt_genai(
     elif storage_uri:
         contents.append(Part.from_uri(file_uri=storage_uri, mime_type="audio/wav"))
 
-    response = await genai_client.aio.models.generate_content(
+    response = await get_genai_client().aio.models.generate_content(
         model="gemini-2.0-flash-exp",
         contents=contents,
         # config=GenerateContentConfig(
@@ -319,28 +336,37 @@ async def stt_genai(
     return response.text
 
 
-def pcm_to_wav_bytes(pcm_bytes, sample_rate=16000, channels=1, sample_width=2):
-    """
-    PCMバイトデータをWAVバイトデータに変換します。
+def build_stt_router(language_code: str = "ja-JP", **kwargs) -> SttRouter:
+    """3つの文字起こし実装を共通のインターフェースで束ねたルーターを作成します。"""
 
-    :param pcm_bytes: PCM形式の音声データ
-    :param sample_rate: サンプルレート
-    :param channels: チャンネル数(モノラル=1、ステレオ=2)
-    :param sample_width: サンプル幅(バイト単位、ex. 16ビット=2)
-    :return: WAV形式の音声データ
-    """
-    with io.BytesIO() as wav_io:
-        # WAVファイルの書き込み用にwaveモジュールを使用
-        with wave.open(wav_io, "wb") as wav_file:
-            wav_file.setnchannels(channels)
-            wav_file.setsampwidth(sample_width)
-            wav_file.setframerate(sample_rate)
-            wav_file.writeframes(pcm_bytes)
-
-        # バイトデータとして取得
-        wav_bytes = wav_io.getvalue()
-
-    return wav_bytes
+    async def google(request: SttRequest) -> str:
+        return await stt_google(
+            sample_rate=request.sample_rate,
+            language_code=language_code,
+            audio_bytes=request.audio_bytes,
+            storage_uri=request.storage_uri,
+        )
+
+    async def google_v2(request: SttRequest) -> str:
+        return await stt_google_v2(
+            language_code=language_code,
+            audio_bytes=request.audio_bytes,
+            storage_uri=request.storage_uri,
+        )
+
+    async def genai(request: SttRequest) -> str:
+        return await stt_genai(
+            audio_bytes=request.audio_bytes, storage_uri=request.storage_uri
+        )
+
+    return SttRouter(
+        [
+            SttBackend("google_v2", google_v2),
+            SttBackend("google", google),
+            SttBackend("genai", genai),
+        ],
+        **kwargs,
+    )
 
 
 def open_wav(file_path: str):
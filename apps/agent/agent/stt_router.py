@@ -0,0 +1,174 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+
+@dataclass
+class SttRequest:
+    sample_rate: int = 16_000
+    audio_bytes: Optional[bytes] = None
+    storage_uri: Optional[str] = None
+
+
+Transcriber = Callable[[SttRequest], Awaitable[str]]
+
+
+@dataclass
+class SttBackend:
+    """文字起こしバックエンドと、そのレイテンシ・エラーの統計"""
+
+    name: str
+    transcribe: Transcriber
+    window: int = 100
+    failure_threshold: int = 3
+    cooldown: float = 30.0
+
+    latencies: deque = field(init=False)
+    outcomes: deque = field(init=False)
+    consecutive_failures: int = field(default=0, init=False)
+    open_until: float = field(default=0.0, init=False)
+
+    def __post_init__(self) -> None:
+        self.latencies = deque(maxlen=self.window)
+        self.outcomes = deque(maxlen=self.window)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def is_available(self, now: float) -> bool:
+        # cooldown経過後はhalf-openとして1回だけ試行を許す
+        return now >= self.open_until
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, now: float) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = now + self.cooldown
+            print(f"[stt] circuit open: {self.name} ({self.cooldown:.0f}s)")
+
+    def record_cancelled(self, elapsed: float) -> None:
+        # ヘッジで負けた場合も「少なくともelapsed秒かかった」として記録し、
+        # 遅いバックエンドが統計上いつまでも速く見えないようにする
+        self.latencies.append(elapsed)
+
+    def score(self) -> tuple:
+        """小さいほど優先する並び順のキー"""
+        # 一度も試していないバックエンドは優先して計測する
+        if not self.outcomes and not self.latencies:
+            return (0,)
+        # エラー率で並べ、同程度(10%刻み)ならp50の速い方を選ぶ
+        p50 = self.percentile(0.5)
+        return (1, round(self.error_rate, 1), float("inf") if p50 is None else p50)
+
+
+class SttRouter:
+    """最も速い正常なバックエンドへ振り分け、p95超過時には2つ目へヘッジする"""
+
+    def __init__(
+        self,
+        backends: list[SttBackend],
+        timeout: float = 30.0,
+        hedge: bool = True,
+        min_hedge_samples: int = 10,
+    ) -> None:
+        if not backends:
+            raise ValueError("At least one backend is required")
+        self.backends = backends
+        self.timeout = timeout
+        self.hedge = hedge
+        self.min_hedge_samples = min_hedge_samples
+
+    def ranked(self) -> list[SttBackend]:
+        now = time.monotonic()
+        available = [b for b in self.backends if b.is_available(now)]
+        # すべて遮断中なら、最も早く復帰するものから試す
+        if not available:
+            return sorted(self.backends, key=lambda b: b.open_until)
+        return sorted(available, key=lambda b: b.score())
+
+    def _hedge_delay(self, backend: SttBackend) -> Optional[float]:
+        if not self.hedge or len(backend.latencies) < self.min_hedge_samples:
+            return None
+        return backend.percentile(0.95)
+
+    async def transcribe(self, request: SttRequest) -> str:
+        candidates = self.ranked()
+        deadline = time.monotonic() + self.timeout
+        running: dict[asyncio.Task, tuple[SttBackend, float]] = {}
+        errors: list[BaseException] = []
+
+        def launch() -> Optional[float]:
+            backend = candidates.pop(0)
+            task = asyncio.create_task(backend.transcribe(request))
+            running[task] = (backend, time.monotonic())
+            delay = self._hedge_delay(backend)
+            return None if delay is None else time.monotonic() + delay
+
+        hedge_at = launch()
+        try:
+            while running:
+                now = time.monotonic()
+                if now >= deadline:
+                    for backend, _ in running.values():
+                        backend.record_failure(now)
+                    raise asyncio.TimeoutError(
+                        f"Transcription timed out after {self.timeout}s"
+                    )
+                wake = deadline
+                if hedge_at is not None and candidates and len(running) < 2:
+                    if now >= hedge_at:
+                        print(f"[stt] hedging to {candidates[0].name}")
+                        hedge_at = launch()
+                        continue
+                    wake = min(wake, hedge_at)
+
+                done, _ = await asyncio.wait(
+                    running, timeout=wake - now, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    backend, started = running.pop(task)
+                    finished = time.monotonic()
+                    if task.exception() is None:
+                        backend.record_success(finished - started)
+                        return task.result()
+                    backend.record_failure(finished)
+                    errors.append(task.exception())
+                    print(f"[stt] {backend.name} failed: {task.exception()!r}")
+                    # 失敗したら待たずに次のバックエンドへ切り替える
+                    if candidates and not running:
+                        hedge_at = launch()
+        finally:
+            now = time.monotonic()
+            for task, (backend, started) in running.items():
+                task.cancel()
+                backend.record_cancelled(now - started)
+
+        raise RuntimeError(f"All transcription backends failed: {errors}")
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            b.name: {
+                "p50": b.percentile(0.5),
+                "p95": b.percentile(0.95),
+                "error_rate": b.error_rate,
+                "open": not b.is_available(time.monotonic()),
+            }
+            for b in self.backends
+        }
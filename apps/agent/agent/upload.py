@@ -0,0 +1,196 @@
+import asyncio
+import os
+import tempfile
+from typing import IO, TYPE_CHECKING, Optional, Union
+
+from agent.audio import wav_header
+from agent.storage import get_bucket
+
+if TYPE_CHECKING:
+    from google.cloud.storage import Blob
+
+# 1パートあたりのPCMバイト数 (16kHz/16bit/モノラルで約8秒)
+PART_SIZE = 256 * 1024
+# メモリ上で送信待ちにできるパート数。これを超えた分は一時ファイルに書き出す
+MAX_PENDING_PARTS = 4
+# Cloud Storageのcomposeは1回あたり最大32オブジェクトまで
+MAX_COMPOSE_SOURCES = 32
+
+
+class StreamingWavUpload:
+    """録音中のPCMを一定サイズのパートに分けてアップロードし、最後にWAVとして合成する
+
+    パートはWAVヘッダーなしの一時オブジェクトとしてアップロードし、
+    ターン終了時にデータ長の確定したヘッダーを先頭に付けてcomposeする。
+    write()はパートをキューに積むだけで、送信はバックグラウンドのタスクが行うので、
+    回線が遅くても受信ループは待たされない。送信が追いつかない間は、
+    max_pending_parts個を超えたパートを一時ファイルに書き出して、メモリ使用量を
+    (max_pending_parts + 2) * part_size程度に抑える。
+    アップロードのエラーは呼び出し側に投げず、close()がNoneを返す。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sample_rate: int = 16000,
+        channels: int = 1,
+        sample_width: int = 2,
+        part_size: int = PART_SIZE,
+        max_pending_parts: int = MAX_PENDING_PARTS,
+    ) -> None:
+        self.name = name
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.part_size = part_size
+        self.max_pending_parts = max_pending_parts
+
+        self._buffer = bytearray()
+        self._parts: list["Blob"] = []
+        self._temporaries: list["Blob"] = []
+        # パートのデータは、メモリ上のbytesか一時ファイル上の(offset, size)
+        self._queue: asyncio.Queue[
+            Optional[tuple["Blob", Union[bytes, tuple[int, int]]]]
+        ] = asyncio.Queue()
+        self._in_memory = 0
+        self._spill_file: Optional[IO[bytes]] = None
+        self._spill_size = 0
+        self._worker: Optional[asyncio.Task] = None
+        self._error: Optional[Exception] = None
+        self._data_size = 0
+        self.spilled = 0
+
+    def write(self, pcm: bytes) -> None:
+        if self._error:
+            return
+        self._buffer += pcm
+        self._data_size += len(pcm)
+        if len(self._buffer) >= self.part_size:
+            part, data = self._take_part()
+            if self._in_memory < self.max_pending_parts:
+                self._in_memory += 1
+                self._queue.put_nowait((part, data))
+            else:
+                # 送信が追いついていないので、メモリに溜めずに一時ファイルへ逃がす
+                self._queue.put_nowait((part, self._spill(data)))
+            self._start_worker()
+
+    async def close(self) -> Optional["Blob"]:
+        """残りのパートを送信し、ヘッダーと全パートを合成したWAVオブジェクトを返す
+
+        途中でアップロードに失敗していた場合は、一時オブジェクトを消してNoneを返す。
+        """
+        if self._buffer and not self._error:
+            self._in_memory += 1
+            self._queue.put_nowait(self._take_part())
+            self._start_worker()
+        await self._stop_worker()
+
+        try:
+            if self._error:
+                raise self._error
+            header = self._temp_blob("header")
+            await asyncio.to_thread(
+                header.upload_from_string,
+                wav_header(
+                    self._data_size,
+                    sample_rate=self.sample_rate,
+                    channels=self.channels,
+                    sample_width=self.sample_width,
+                ),
+                content_type="application/octet-stream",
+            )
+            self._parts.insert(0, header)
+
+            blob = get_bucket().blob(self.name)
+            blob.content_type = "audio/wav"
+            await asyncio.to_thread(blob.compose, self._parts)
+        except Exception as e:
+            print(f"Failed to upload {self.name}: {e}")
+            blob = None
+        await self._delete_temporaries()
+        return blob
+
+    async def abort(self) -> None:
+        """送信済みの一時オブジェクトを削除する"""
+        self._buffer = bytearray()
+        await self._stop_worker()
+        await self._delete_temporaries()
+
+    def _take_part(self) -> tuple["Blob", bytes]:
+        part = self._temp_blob(f"{len(self._temporaries):05d}")
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        return part, data
+
+    def _start_worker(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def _stop_worker(self) -> None:
+        if self._worker:
+            worker, self._worker = self._worker, None
+            # 送信待ちのパートを送り終えたら止まる
+            self._queue.put_nowait(None)
+            await worker
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _spill(self, data: bytes) -> tuple[int, int]:
+        if self._spill_file is None:
+            print(f"Upload of {self.name} is falling behind, spilling parts to disk")
+            self._spill_file = tempfile.TemporaryFile()
+        # ワーカーのスレッドが同時に読むので、ファイル位置を共有しないpwrite/preadを使う
+        offset = self._spill_size
+        os.pwrite(self._spill_file.fileno(), data, offset)
+        self._spill_size += len(data)
+        self.spilled += 1
+        return offset, len(data)
+
+    def _read_spilled(self, offset: int, size: int) -> bytes:
+        return os.pread(self._spill_file.fileno(), size, offset)
+
+    async def _run(self) -> None:
+        while (item := await self._queue.get()) is not None:
+            part, data = item
+            try:
+                if self._error:
+                    # 失敗した後のパートは合成できないので捨てる
+                    continue
+                if isinstance(data, tuple):
+                    data = await asyncio.to_thread(self._read_spilled, *data)
+                await self._upload_part(part, data)
+            except Exception as e:
+                print(f"Failed to upload a part of {self.name}: {e}")
+                self._error = e
+            finally:
+                if isinstance(item[1], bytes):
+                    self._in_memory -= 1
+
+    async def _upload_part(self, part: "Blob", data: bytes) -> None:
+        await asyncio.to_thread(
+            part.upload_from_string, data, content_type="application/octet-stream"
+        )
+        self._parts.append(part)
+
+        # ヘッダー分の1枠を残して、溜まったパートを中間オブジェクトへまとめる
+        if len(self._parts) >= MAX_COMPOSE_SOURCES - 1:
+            merged = self._temp_blob(f"merged-{len(self._temporaries):05d}")
+            await asyncio.to_thread(merged.compose, self._parts)
+            self._parts = [merged]
+
+    async def _delete_temporaries(self) -> None:
+        if self._temporaries:
+            temporaries, self._temporaries = self._temporaries, []
+            try:
+                await asyncio.to_thread(
+                    get_bucket().delete_blobs, temporaries, on_error=lambda blob: None
+                )
+            except Exception as e:
+                print(f"Failed to delete temporary parts of {self.name}: {e}")
+
+    def _temp_blob(self, suffix: str) -> "Blob":
+        blob = get_bucket().blob(f"{self.name}.parts/{suffix}")
+        self._temporaries.append(blob)
+        return blob
@@ -0,0 +1,118 @@
+"""新着メッセージ通知(LISTEN/NOTIFY)の計測
+
+ローカルのPostgresに対して、MessagePublisherで送った通知がLISTEN側に
+届くまでの遅延と、ポーリングした場合と比べたクエリ数を計測する。
+LISTENにはasyncpgを使う(エージェント本体の依存には含めず、devグループにしている)。
+
+    uv sync --group dev
+    python -m benchmarks.notify --messages 200 --poll-interval 1.0
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from prisma import Prisma
+
+from agent.config import config
+from agent.notify import CHANNEL, MessagePublisher
+
+TRANSACTIONS_QUERY = (
+    "SELECT xact_commit + xact_rollback FROM pg_stat_database"
+    " WHERE datname = current_database()"
+)
+
+
+async def transactions(conn) -> int:
+    # pg_stat_databaseの統計は、トランザクションを閉じないと更新されない
+    await conn.execute("SELECT pg_stat_clear_snapshot()")
+    return await conn.fetchval(TRANSACTIONS_QUERY)
+
+
+async def measure_notify(conn, count: int, interval: float) -> tuple[list[float], int]:
+    latencies = []
+    received = asyncio.Event()
+
+    def on_notify(connection, pid, channel, payload):
+        latencies.append(time.time() - json.loads(payload)["publishedAt"])
+        if len(latencies) == count:
+            received.set()
+
+    await conn.add_listener(CHANNEL, on_notify)
+    publisher = MessagePublisher()
+    runner = asyncio.create_task(publisher.run())
+    before = await transactions(conn)
+    for i in range(count):
+        publisher.publish(
+            SimpleNamespace(
+                id=str(uuid.uuid4()),
+                speaker="USER",
+                contentTranscript=f"benchmark message {i}",
+                sentAt=datetime.now(timezone.utc),
+            )
+        )
+        await asyncio.sleep(interval)
+    await asyncio.wait_for(received.wait(), timeout=10)
+    after = await transactions(conn)
+    runner.cancel()
+    await conn.remove_listener(CHANNEL, on_notify)
+    return latencies, after - before
+
+
+async def measure_polling(conn, duration: float, poll_interval: float) -> int:
+    # Webアプリが新着を知るためにmessagesを再取得し続けた場合
+    prisma = Prisma()
+    await prisma.connect()
+    before = await transactions(conn)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        await prisma.message.find_many(take=50, order={"sentAt": "desc"})
+        await asyncio.sleep(poll_interval)
+    after = await transactions(conn)
+    await prisma.disconnect()
+    return after - before
+
+
+async def main() -> None:
+    import asyncpg
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    conn = await asyncpg.connect(config.database_url)
+    prisma = Prisma(auto_register=True)
+    await prisma.connect()
+    try:
+        started = time.monotonic()
+        latencies, notify_queries = await measure_notify(
+            conn, args.messages, args.interval
+        )
+        duration = time.monotonic() - started
+        polling_queries = await measure_polling(conn, duration, args.poll_interval)
+    finally:
+        await prisma.disconnect()
+        await conn.close()
+
+    ordered = sorted(latencies)
+    print(
+        f"delivered {len(latencies)}/{args.messages} notifications:"
+        f" p50={statistics.median(ordered) * 1000:.1f}ms"
+        f" p95={ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000:.1f}ms"
+    )
+    # 計測用の接続自身のクエリも含むので、どちらも同じだけ上乗せされている
+    print(
+        f"transactions over {duration:.1f}s: notify={notify_queries},"
+        f" polling every {args.poll_interval}s={polling_queries}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,319 @@
+"""エージェントのホットパスのマイクロベンチマーク
+
+ハードウェアやネットワークなしで実行でき、1回あたりの時間とメモリを
+benchmarks/baseline.jsonと比較して、しきい値を超えたら終了コード1を返す。
+ベースラインはマシン(アーキテクチャとPythonのバージョン)ごとに持つ。
+そのマシンのベースラインがなければ、時間は比較せずメモリだけを比較する。
+
+    python -m benchmarks.run                    # ベースラインと比較
+    python -m benchmarks.run --update-baseline  # ベースラインを更新
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from agent.audio import (
+    TurnAssembler,
+    has_nonzero,
+    is_low_volume,
+    mean_abs_amplitude,
+    pcm_to_wav_bytes,
+)
+from agent.frames import encode_frame
+from agent.resample import StreamingResampler
+
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+MACHINE = f"{platform.machine()} / Python {platform.python_version()}"
+
+# リサンプリング後に残ってよい、変換後のナイキスト周波数を超える成分の大きさ
+MAX_ALIAS_DB = -60
+
+# ベースラインからの悪化をどこまで許容するか
+TIME_THRESHOLD = 1.5
+PEAK_THRESHOLD = 1.2
+PEAK_SLACK_KIB = 64
+
+SEND_SAMPLE_RATE = 16000
+RECEIVE_SAMPLE_RATE = 24000
+CHUNK_SIZE = 1024
+
+BENCHMARKS: dict[str, Callable[[], Callable[[], object]]] = {}
+CHECKS: dict[str, Callable[[], tuple[bool, str]]] = {}
+
+
+def benchmark(name: str):
+    """入力を準備して、計測対象の関数を返すセットアップ関数を登録する"""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def accuracy_check(name: str):
+    def register(func):
+        CHECKS[name] = func
+        return func
+
+    return register
+
+
+def _pcm(seconds: float, sample_rate: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 3000, int(seconds * sample_rate))
+    return samples.clip(-32768, 32767).astype(np.int16).tobytes()
+
+
+@benchmark("pcm_to_wav_bytes/user_5s")
+def _():
+    pcm = _pcm(5, SEND_SAMPLE_RATE)
+    return lambda: pcm_to_wav_bytes(pcm, sample_rate=SEND_SAMPLE_RATE)
+
+
+@benchmark("pcm_to_wav_bytes/system_30s")
+def _():
+    pcm = _pcm(30, RECEIVE_SAMPLE_RATE)
+    return lambda: pcm_to_wav_bytes(pcm, sample_rate=RECEIVE_SAMPLE_RATE)
+
+
+@benchmark("mean_abs_amplitude/chunk")
+def _():
+    chunk = _pcm(CHUNK_SIZE / SEND_SAMPLE_RATE, SEND_SAMPLE_RATE)
+    return lambda: mean_abs_amplitude(chunk)
+
+
+@benchmark("is_low_volume/chunk")
+def _():
+    chunk = _pcm(CHUNK_SIZE / SEND_SAMPLE_RATE, SEND_SAMPLE_RATE)
+    return lambda: is_low_volume(chunk)
+
+
+@benchmark("has_nonzero/system_chunk")
+def _():
+    # 無音のチャンクは最後まで走査するので最悪ケースになる
+    chunk = bytes(CHUNK_SIZE * 2 * 8)
+    return lambda: has_nonzero(chunk)
+
+
+@benchmark("encode_frame/1080p_xrgb")
+def _():
+    rng = np.random.default_rng(0)
+    # ノイズだとJPEGが極端に重くなるので、なめらかなグラデーションに少しノイズを乗せる
+    y, x = np.mgrid[0:1080, 0:1920]
+    frame = np.empty((1080, 1920, 4), dtype=np.uint8)
+    frame[..., 0] = (x * 255 // 1919).astype(np.uint8)
+    frame[..., 1] = (y * 255 // 1079).astype(np.uint8)
+    frame[..., 2] = rng.integers(0, 32, (1080, 1920), dtype=np.uint8)
+    frame[..., 3] = 255
+
+    def run():
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
+        return encode_frame(frame_rgb)
+
+    return run
+
+
+@benchmark("turn_assembly/user_30s")
+def _():
+    # 30秒の発話の後、3秒の無音でターンが切り出されるまで(listen_audioと同じ処理)
+    chunk = _pcm(CHUNK_SIZE / SEND_SAMPLE_RATE, SEND_SAMPLE_RATE)
+    silence = bytes(len(chunk))
+    speech_count = 30 * SEND_SAMPLE_RATE // CHUNK_SIZE
+    silence_count = -(-3 * SEND_SAMPLE_RATE // CHUNK_SIZE)
+
+    def run():
+        turns = TurnAssembler(sample_rate=SEND_SAMPLE_RATE)
+        for _ in range(speech_count):
+            turns.feed(chunk, True)
+        for _ in range(silence_count):
+            turn = turns.feed(silence, False)
+        assert turn is not None
+        return turn
+
+    return run
+
+
+def _resample_benchmark(in_rate: int):
+    # 1秒分の音声をlisten_audioと同じチャンク単位で変換する = 音声1秒あたりのCPU時間
+    chunk_size = CHUNK_SIZE * in_rate // SEND_SAMPLE_RATE
+    pcm = _pcm(1, in_rate)
+    chunks = [pcm[i : i + chunk_size * 2] for i in range(0, len(pcm), chunk_size * 2)]
+
+    def run():
+        resampler = StreamingResampler(in_rate, SEND_SAMPLE_RATE)
+        return [resampler.process(chunk) for chunk in chunks]
+
+    return run
+
+
+@benchmark("resample/48k_to_16k_per_sec")
+def _():
+    return _resample_benchmark(48000)
+
+
+@benchmark("resample/44.1k_to_16k_per_sec")
+def _():
+    return _resample_benchmark(44100)
+
+
+@benchmark("resample/24k_to_16k_per_sec")
+def _():
+    return _resample_benchmark(RECEIVE_SAMPLE_RATE)
+
+
+def _alias_check(in_rate: int) -> tuple[bool, str]:
+    # 変換後のナイキスト周波数より上のトーンは、折り返さずに消えなければならない
+    t = np.arange(in_rate) / in_rate
+    worst = -np.inf
+    for freq in np.linspace(SEND_SAMPLE_RATE / 2 * 1.15, in_rate / 2 * 0.95, 8):
+        tone = (10000 * np.sin(2 * np.pi * freq * t)).astype(np.int16)
+        resampler = StreamingResampler(in_rate, SEND_SAMPLE_RATE)
+        out = np.frombuffer(resampler.process(tone.tobytes()), dtype=np.int16)
+        rms = np.sqrt(np.mean(out[256:-256].astype(np.float64) ** 2))
+        worst = max(worst, 20 * np.log10(max(rms, 1e-3) / (10000 / np.sqrt(2))))
+    return worst <= MAX_ALIAS_DB, f"worst alias {worst:.1f}dB (<= {MAX_ALIAS_DB}dB)"
+
+
+@accuracy_check("resample/48k_alias")
+def _():
+    return _alias_check(48000)
+
+
+@accuracy_check("resample/44.1k_alias")
+def _():
+    return _alias_check(44100)
+
+
+@accuracy_check("resample/24k_alias")
+def _():
+    return _alias_check(RECEIVE_SAMPLE_RATE)
+
+
+def measure(func: Callable[[], object], min_time: float = 0.5) -> dict:
+    func()  # warm up
+
+    # 1回あたりの時間は、min_time秒以上回したうえでの中央値
+    timings = []
+    started = time.perf_counter()
+    while time.perf_counter() - started < min_time or len(timings) < 5:
+        t = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t)
+
+    # tracemallocは遅いので、メモリは1回だけ別に計る
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+
+    # 呼び出しが確保して戻り値などとして残ったブロック数(tracemalloc自身の分は除く)
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    allocations = sum(
+        max(stat.count_diff, 0)
+        for stat in after.filter_traces(ignore).compare_to(
+            before.filter_traces(ignore), "lineno"
+        )
+    )
+    return {
+        "time_us": round(statistics.median(timings) * 1e6, 2),
+        "peak_kib": round((peak - base) / 1024, 2),
+        "allocations": allocations,
+    }
+
+
+def check(
+    name: str, result: dict, baseline: dict, compare_time: bool = True
+) -> list[str]:
+    if name not in baseline:
+        return []
+    expected = baseline[name]
+    problems = []
+    if compare_time and result["time_us"] > expected["time_us"] * TIME_THRESHOLD:
+        problems.append(
+            f"time {result['time_us']:.1f}us"
+            f" > {expected['time_us']:.1f}us x {TIME_THRESHOLD}"
+        )
+    if result["peak_kib"] > expected["peak_kib"] * PEAK_THRESHOLD + PEAK_SLACK_KIB:
+        problems.append(
+            f"peak {result['peak_kib']:.1f}KiB"
+            f" > {expected['peak_kib']:.1f}KiB x {PEAK_THRESHOLD}"
+        )
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-k", "--filter", default="", help="名前に含まれる文字列で絞り込む"
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--min-time", type=float, default=0.5)
+    args = parser.parse_args()
+
+    baselines = {}
+    if BASELINE_PATH.exists():
+        baselines = json.loads(BASELINE_PATH.read_text())["machines"]
+    baseline = baselines.get(MACHINE)
+    compare_time = baseline is not None
+    if baseline is None:
+        # 時間はマシンによって大きく変わるが、メモリはほぼ変わらないので流用する
+        baseline = next(iter(baselines.values()), {})
+        if baselines and not args.update_baseline:
+            print(
+                f"No baseline for {MACHINE}; comparing memory only."
+                " Run with --update-baseline on this machine to compare time."
+            )
+
+    results = {}
+    failed = False
+    print(f"{'benchmark':<32} {'time/call':>12} {'peak':>12} {'allocs':>8}")
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        result = measure(setup(), min_time=args.min_time)
+        results[name] = result
+        problems = []
+        if not args.update_baseline:
+            problems = check(name, result, baseline, compare_time=compare_time)
+        failed = failed or bool(problems)
+        line = (
+            f"{name:<32} {result['time_us']:>10.1f}us {result['peak_kib']:>9.1f}KiB "
+            f"{result['allocations']:>8}"
+        )
+        if problems:
+            line += "  REGRESSION: " + "; ".join(problems)
+        print(line)
+
+    for name, func in CHECKS.items():
+        if args.filter not in name:
+            continue
+        ok, message = func()
+        failed = failed or not ok
+        print(f"{name:<32} {'ok' if ok else 'FAILED'}: {message}")
+
+    if args.update_baseline:
+        baselines[MACHINE] = {**baselines.get(MACHINE, {}), **results}
+        BASELINE_PATH.write_text(json.dumps({"machines": baselines}, indent=2) + "\n")
+        print(f"Updated {BASELINE_PATH}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""文字起こし検索のベンチマーク
+
+DATABASE_URLのDBに対してsearch_messages()を実行し、検索レイテンシを計測する。
+--seed-databaseを付けると、合成した会話をN件messagesテーブルへ投入してから
+計測する(書き込むのでローカルDBで使うこと)。
+
+    python -m benchmarks.search --messages 1000000 --seed-database
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from agent.search import search_messages
+
+WORDS = [
+    "今日", "明日", "天気", "晴れ", "雨", "カメラ", "マイク", "ごはん", "学校", "公園",
+    "おもちゃ", "ゲーム", "先生", "友達", "お母さん", "お父さん", "電車", "バス",
+    "宿題", "算数", "ひらがな", "カタカナ", "動物", "ねこ", "いぬ", "うさぎ",
+    "図書館", "絵本", "お絵かき", "サッカー", "野球", "水泳", "ピアノ", "歌",
+    "楽しい", "嬉しい", "眠い", "お腹", "すいた", "見て", "教えて", "どうして",
+    "なんで", "すごい", "かわいい", "おいしい", "ありがとう", "こんにちは", "おやすみ",
+]
+PARTICLES = ["は", "が", "を", "に", "で", "と", "も", "の", "ね", "よ"]
+
+
+def synthetic_transcript(rng: random.Random) -> str:
+    words = []
+    for _ in range(rng.randint(3, 12)):
+        words.append(rng.choice(WORDS) + rng.choice(PARTICLES))
+    return "".join(words) + rng.choice(["。", "？", "！"])
+
+
+def synthetic_messages(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    step = timedelta(days=365) / count
+    for i in range(count):
+        id = str(uuid.UUID(int=rng.getrandbits(128)))
+        yield id, synthetic_transcript(rng), start + step * i
+
+
+async def seed_database(count: int, batch_size: int = 5_000) -> None:
+    from prisma.models import Message
+
+    started = time.perf_counter()
+    batch = []
+    for id, transcript, sent_at in synthetic_messages(count):
+        batch.append(
+            {
+                "id": id,
+                "contentURL": "",
+                "contentTranscript": transcript,
+                "sentAt": sent_at,
+                "speaker": "USER",
+            }
+        )
+        if len(batch) == batch_size:
+            await Message.prisma().create_many(data=batch, skip_duplicates=True)
+            batch = []
+    if batch:
+        await Message.prisma().create_many(data=batch, skip_duplicates=True)
+    elapsed = time.perf_counter() - started
+    print(f"seed: {count} messages in {elapsed:.1f}s")
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(args: argparse.Namespace) -> None:
+    from prisma import Prisma
+
+    prisma = Prisma(auto_register=True)
+    await prisma.connect()
+    try:
+        if args.seed_database:
+            await seed_database(args.messages)
+
+        rng = random.Random(1)
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        for label, window in [("all time", None), ("7 days", timedelta(days=7))]:
+            latencies = []
+            for _ in range(args.queries):
+                query = rng.choice(WORDS) + rng.choice(PARTICLES) + rng.choice(WORDS)
+                since = until = None
+                if window:
+                    since = start + timedelta(days=rng.uniform(0, 358))
+                    until = since + window
+                t = time.perf_counter()
+                await search_messages(query, since=since, until=until)
+                latencies.append(time.perf_counter() - t)
+            print(
+                f"search ({label}): p50={statistics.median(latencies) * 1000:.1f}ms"
+                f" p95={percentile(latencies, 0.95) * 1000:.1f}ms"
+            )
+    finally:
+        await prisma.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed-database", action="store_true")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+from agent.audio import TurnAssembler
+
+CHUNK = 1024  # サンプル数
+SPEECH = b"\x10\x10" * CHUNK
+SILENCE = bytes(CHUNK * 2)
+
+
+def test_turn_ends_after_three_seconds_of_silence():
+    turns = TurnAssembler(sample_rate=16000)
+    for _ in range(10):
+        assert turns.feed(SPEECH, True) is None
+
+    silent_chunks = 0
+    turn = None
+    while turn is None:
+        turn = turns.feed(SILENCE, False)
+        silent_chunks += 1
+
+    assert silent_chunks * CHUNK >= 16000 * 3
+    assert (silent_chunks - 1) * CHUNK < 16000 * 3
+    assert turn == SPEECH * 10 + SILENCE * silent_chunks
+
+
+def test_flush_drops_blocks_that_are_too_short():
+    turns = TurnAssembler(sample_rate=16000)
+    turns.feed(SPEECH, True)
+    assert turns.flush() is None
+
+    turns.feed(SPEECH, True)
+    turns.feed(SPEECH, True)
+    assert turns.flush() == SPEECH * 2
@@ -0,0 +1,34 @@
+from agent.bandwidth import BandwidthGovernor
+
+# 段階ごとのフレームサイズ(バイト)
+FRAME_BYTES = [80_000, 50_000, 30_000, 18_000, 12_000, 7_000]
+
+
+def simulate(target_bps: float, seconds: float = 120.0) -> list[int]:
+    """音声32KB/s、2秒ごとのフレームを送ったときの段階の推移"""
+    now = [0.0]
+    governor = BandwidthGovernor(target_bps, clock=lambda: now[0])
+    levels = []
+    for step in range(int(seconds * 10)):
+        now[0] = step * 0.1
+        governor.record_send(3_200, send_time=0.001, queue_delay=0.0)
+        if step % 20 == 0:
+            nbytes = FRAME_BYTES[governor.level]
+            governor.record_frame(nbytes)
+            governor.record_send(nbytes, send_time=0.001, queue_delay=0.0)
+        levels.append(governor.level)
+    return levels
+
+
+def test_single_congestion_steps_down_one_rung():
+    # 768px/q60なら収まる帯域で、1024px/q70から一気に下げすぎない
+    levels = simulate(450_000)
+    assert max(levels) == 2
+    assert levels[-1] == 2
+
+
+def test_does_not_oscillate_after_settling():
+    levels = simulate(400_000)
+    settled = levels[len(levels) // 2 :]
+    changes = sum(1 for a, b in zip(settled, settled[1:]) if a != b)
+    assert changes == 0
@@ -0,0 +1,56 @@
+import pytest
+
+from agent.capture import _SLOT, ShmRing
+
+
+@pytest.fixture
+def ring():
+    ring = ShmRing(slots=4, slot_size=16)
+    yield ring
+    ring.close()
+
+
+def test_reads_in_write_order(ring):
+    for i in range(3):
+        ring.write(bytes([i]) * (i + 1))
+
+    seq = 0
+    items = []
+    while (item := ring.read(seq)) is not None:
+        seq, data = item
+        items.append((seq, data))
+
+    assert items == [(1, b"\x00"), (2, b"\x01\x01"), (3, b"\x02\x02\x02")]
+
+
+def test_lagging_reader_skips_overwritten_slots(ring):
+    for i in range(10):
+        ring.write(bytes([i]))
+
+    # 4スロットなので、1〜6番は上書きされている
+    assert ring.read(0) == (7, b"\x06")
+    assert ring.read(7) == (8, b"\x07")
+    assert ring.read(10) is None
+
+
+def test_slot_being_written_is_not_returned(ring):
+    seq = ring.write(b"old")
+    # 書き込み中の状態(番号0)を再現する
+    _SLOT.pack_into(ring.shm.buf, ring._offset(seq), 0, 0)
+
+    assert ring.read(seq - 1) is None
+
+
+def test_attached_reader_sees_writes(ring):
+    reader = ShmRing(ring.name)
+    try:
+        ring.write(b"hello")
+        assert (reader.slots, reader.slot_size) == (4, 16)
+        assert reader.read(0) == (1, b"hello")
+    finally:
+        reader.close()
+
+
+def test_rejects_data_larger_than_a_slot(ring):
+    with pytest.raises(ValueError):
+        ring.write(bytes(17))
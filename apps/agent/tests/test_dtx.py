@@ -0,0 +1,33 @@
+from agent.dtx import SilenceGate
+
+CHUNK_SEC = 0.064
+
+
+def run_gate(speech_at: set[int], count: int) -> list[int]:
+    """チャンクの番号を流し、送られた番号を送られた順に返す"""
+    now = [0.0]
+    gate = SilenceGate(chunk_sec=CHUNK_SEC, clock=lambda: now[0])
+    sent = []
+    for i in range(count):
+        now[0] = i * CHUNK_SEC
+        chunks = gate.process(i.to_bytes(4, "little"), is_speech=i in speech_at)
+        sent += [int.from_bytes(chunk, "little") for chunk in chunks]
+    return sent
+
+
+def test_silence_is_suppressed_except_keepalive():
+    sent = run_gate(set(), 200)
+    # 5秒ごとのキープアライブだけが送られる
+    assert sent == [79, 158]
+
+
+def test_sent_chunks_stay_in_order_after_keepalive():
+    # キープアライブ(79番)の直後に発話が始まっても、古いプリロールを後から送らない
+    sent = run_gate({80}, 100)
+    assert sent == sorted(sent)
+    assert sent[:2] == [79, 80]
+
+
+def test_pre_roll_is_sent_before_speech():
+    sent = run_gate({50}, 60)
+    assert sent[:6] == [45, 46, 47, 48, 49, 50]
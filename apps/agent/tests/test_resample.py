@@ -0,0 +1,58 @@
+import random
+
+import numpy as np
+import pytest
+
+from agent.resample import StreamingResampler, resample
+
+RATES = [(48000, 16000), (44100, 16000), (16000, 24000), (24000, 16000)]
+
+
+def tone(freq: float, rate: int, seconds: float = 1.0, amplitude: float = 10000):
+    t = np.arange(int(rate * seconds)) / rate
+    return (amplitude * np.sin(2 * np.pi * freq * t)).astype(np.int16).tobytes()
+
+
+def rms(pcm: bytes, trim: int = 0) -> float:
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+    if trim:
+        samples = samples[trim:-trim]
+    return float(np.sqrt(np.mean(samples**2)))
+
+
+@pytest.mark.parametrize("in_rate,out_rate", RATES)
+def test_random_chunks_match_one_shot(in_rate, out_rate):
+    rng = np.random.default_rng(0)
+    pcm = rng.integers(-8000, 8000, in_rate, dtype=np.int16).tobytes()
+    chunk_sizes = random.Random(in_rate + out_rate)
+
+    resampler = StreamingResampler(in_rate, out_rate)
+    chunks = []
+    position = 0
+    while position < len(pcm):
+        size = chunk_sizes.randrange(1, 2000) * 2
+        chunks.append(resampler.process(pcm[position : position + size]))
+        position += size
+
+    expected = resample(pcm, in_rate, out_rate)
+    assert b"".join(chunks) == expected
+    assert len(expected) // 2 == pytest.approx(out_rate, abs=1)
+
+
+@pytest.mark.parametrize("in_rate,out_rate", RATES)
+def test_passband_tone_keeps_its_level(in_rate, out_rate):
+    pcm = tone(1000, in_rate)
+
+    output = resample(pcm, in_rate, out_rate)
+
+    # フィルタの立ち上がり部分を除いて比べる
+    assert rms(output, trim=out_rate // 20) == pytest.approx(rms(pcm), rel=0.01)
+
+
+def test_tone_above_output_nyquist_is_removed():
+    # 48kHzの10kHzは、16kHzに落とすと6kHzに折り返す
+    pcm = tone(10000, 48000)
+
+    output = resample(pcm, 48000, 16000)
+
+    assert rms(output, trim=800) < rms(pcm) * 0.01
@@ -0,0 +1,90 @@
+from agent.backlog import SttBacklog
+from agent.resources import Mode, Reading, ResourceGovernor
+
+CALM = Reading(cpu_load=0.1, loop_lag=0.0, temperature=50.0)
+
+
+def governor_with_clock():
+    now = [0.0]
+    return ResourceGovernor(min_dwell=30.0, clock=lambda: now[0]), now
+
+
+def test_escalates_immediately_to_the_needed_mode():
+    cases = [
+        (Reading(cpu_load=0.96, loop_lag=0.0), Mode.NO_VIDEO),
+        (Reading(cpu_load=0.1, loop_lag=0.2), Mode.DEFER_STT),
+        (Reading(cpu_load=0.1, loop_lag=0.0, temperature=71.0), Mode.REDUCED_VIDEO),
+        (CALM, Mode.NORMAL),
+    ]
+    for reading, mode in cases:
+        assert ResourceGovernor().update(reading) == mode
+
+
+def test_recovers_one_mode_per_min_dwell():
+    governor, now = governor_with_clock()
+    governor.update(Reading(cpu_load=0.96, loop_lag=0.0))
+
+    changes = []
+    for second in range(1, 200):
+        now[0] = float(second)
+        mode = governor.update(CALM)
+        if not changes or changes[-1][1] != mode:
+            changes.append((second, mode))
+
+    # 最初の落ち着いた計測から30秒ごとに1段ずつ戻る
+    assert changes == [
+        (1, Mode.NO_VIDEO),
+        (31, Mode.DEFER_STT),
+        (61, Mode.REDUCED_VIDEO),
+        (91, Mode.NORMAL),
+    ]
+
+
+def test_does_not_flap_between_threshold_and_margin():
+    governor, now = governor_with_clock()
+    governor.update(Reading(cpu_load=0.76, loop_lag=0.0))
+
+    # しきい値0.75とマージン分下の0.65の間では、上がりも下がりもしない
+    for second in range(1, 300):
+        now[0] = float(second)
+        cpu_load = 0.66 if second % 2 else 0.74
+        assert governor.update(Reading(cpu_load, loop_lag=0.0)) == Mode.REDUCED_VIDEO
+
+
+def test_missing_temperature_is_ignored():
+    governor, now = governor_with_clock()
+    governor.update(Reading(cpu_load=0.1, loop_lag=0.0, temperature=81.0))
+
+    for second in range(1, 100):
+        now[0] = float(second)
+        governor.update(Reading(cpu_load=0.1, loop_lag=0.0, temperature=None))
+
+    assert governor.mode == Mode.NORMAL
+
+
+def test_backlog_gives_up_after_max_attempts(tmp_path):
+    backlog = SttBacklog(str(tmp_path / "backlog.jsonl"))
+    backlog.append("a", "a.wav")
+    backlog.append("b", "b.wav")
+
+    # 失敗したエントリは末尾に回る
+    assert backlog.requeue(backlog.peek(), max_attempts=2)
+    assert [e["audio_id"] for e in backlog.entries] == ["b", "a"]
+    assert backlog.entries[-1]["attempts"] == 1
+
+    backlog.remove(backlog.peek())
+    assert not backlog.requeue(backlog.peek(), max_attempts=2)
+    assert len(backlog) == 0
+
+
+def test_backlog_is_reloaded_from_disk(tmp_path):
+    path = str(tmp_path / "backlog.jsonl")
+    backlog = SttBacklog(path)
+    backlog.append("a", "a.wav")
+    backlog.append("b", "b.wav")
+    backlog.requeue(backlog.peek())
+
+    reloaded = SttBacklog(path)
+
+    assert reloaded.entries == backlog.entries
+    assert reloaded.peek() == {"audio_id": "b", "blob_name": "b.wav", "attempts": 0}
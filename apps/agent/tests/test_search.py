@@ -0,0 +1,63 @@
+import asyncio
+import sys
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+from agent.search import like_pattern, search_messages
+
+SENT_AT = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeClient:
+    """query_rawの呼び出しを記録する偽のPrismaクライアント"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    async def query_raw(self, query, *args):
+        self.calls.append((query, args))
+        return self.rows
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeClient(
+        [{"id": "a", "sent_at": SENT_AT, "transcript": "公園に行った", "score": 0.25}]
+    )
+    prisma = types.ModuleType("prisma")
+    prisma.get_client = lambda: client
+    monkeypatch.setitem(sys.modules, "prisma", prisma)
+    return client
+
+
+def test_like_pattern_escapes_wildcards():
+    assert like_pattern("100%_\\") == "%100\\%\\_\\\\%"
+
+
+def test_time_bounds_become_numbered_parameters(client):
+    since = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    until = datetime(2025, 1, 8, tzinfo=timezone.utc)
+
+    results = asyncio.run(search_messages(" 公園 ", since=since, until=until, limit=5))
+
+    query, args = client.calls[0]
+    assert args == ("公園", "%公園%", since.isoformat(), until.isoformat(), 5)
+    assert "posted_at >= $3" in query and "posted_at <= $4" in query
+    assert "LIMIT $5" in query
+    assert results[0].id == "a" and results[0].score == 0.25
+
+
+def test_unbounded_search_has_no_time_conditions(client):
+    asyncio.run(search_messages("公園"))
+
+    query, args = client.calls[0]
+    assert args == ("公園", "%公園%", 20)
+    assert "posted_at >=" not in query and "LIMIT $3" in query
+
+
+def test_blank_query_does_not_hit_the_database(client):
+    assert asyncio.run(search_messages("  ")) == []
+    assert client.calls == []
@@ -0,0 +1,120 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+from agent.segmenter import (
+    ParallelTranscriber,
+    Segment,
+    SilenceSplitter,
+    join_parts,
+    split_at_silences,
+)
+
+RATE = 16000
+
+
+def speech_with_pauses(seconds: float, pauses: list[float], seed: int = 0) -> bytes:
+    """振幅1000前後の雑音に、pausesの各時刻から40msの無音を入れたPCM"""
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(-1000, 1000, int(seconds * RATE), dtype=np.int16)
+    for pause in pauses:
+        start = int(pause * RATE)
+        samples[start : start + RATE * 40 // 1000] = 0
+    return samples.tobytes()
+
+
+def test_cuts_at_the_quietest_frame_within_bounds():
+    pcm = speech_with_pauses(40.0, pauses=[9.0, 21.0, 33.0])
+
+    segments = split_at_silences(pcm, RATE, max_segment_sec=15, min_segment_sec=5)
+
+    # 9.0秒からの無音フレームの中央(10ms後)で区切られる
+    assert len(segments[0].pcm) == int(9.01 * RATE) * 2
+    for segment in segments[:-1]:
+        assert 5 * RATE * 2 <= len(segment.pcm) <= 15 * RATE * 2
+        # 区切り位置の前後は無音
+        tail = np.frombuffer(segment.pcm[-20:], dtype=np.int16)
+        assert not tail.any()
+    assert len(segments) == 4
+
+
+def test_segments_cover_the_input_with_correct_offsets():
+    pcm = speech_with_pauses(50.0, pauses=[7.3, 18.2, 31.9])
+
+    segments = split_at_silences(pcm, RATE, max_segment_sec=10, min_segment_sec=3)
+
+    assert b"".join(segment.pcm for segment in segments) == pcm
+    position = 0
+    for segment in segments:
+        assert segment.offset == position / 2 / RATE
+        position += len(segment.pcm)
+
+
+def test_chunked_feed_matches_one_shot_split():
+    pcm = speech_with_pauses(45.0, pauses=[6.0, 17.5, 29.1], seed=1)
+    rng = random.Random(0)
+
+    splitter = SilenceSplitter(RATE, max_segment_sec=12, min_segment_sec=4)
+    segments = []
+    position = 0
+    while position < len(pcm):
+        size = rng.randrange(1, 8000) * 2
+        segments += splitter.feed(pcm[position : position + size])
+        position += size
+    segments += splitter.flush()
+
+    assert segments == split_at_silences(
+        pcm, RATE, max_segment_sec=12, min_segment_sec=4
+    )
+
+
+def test_rejects_min_not_below_max():
+    with pytest.raises(ValueError):
+        SilenceSplitter(RATE, max_segment_sec=5, min_segment_sec=5)
+
+
+def test_parts_keep_order_when_later_segments_finish_first():
+    segments = [Segment(offset=float(i), pcm=bytes([i])) for i in range(6)]
+
+    async def transcribe(segment):
+        # 後のセグメントほど早く終わる
+        await asyncio.sleep(0.01 * (6 - segment.offset))
+        return str(segment.pcm[0])
+
+    async def run():
+        transcriber = ParallelTranscriber(transcribe, fan_out=3)
+        for segment in segments:
+            transcriber.submit(segment)
+        return await transcriber.parts()
+
+    parts = asyncio.run(run())
+
+    assert parts == [(float(i), str(i)) for i in range(6)]
+    assert join_parts(parts) == "012345"
+
+
+def test_failed_segment_cancels_the_others():
+    cancelled = []
+
+    async def transcribe(segment):
+        if segment.offset == 1.0:
+            await asyncio.sleep(0.01)
+            raise RuntimeError("stt failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(segment.offset)
+            raise
+        return ""
+
+    async def run():
+        transcriber = ParallelTranscriber(transcribe, fan_out=4)
+        for i in range(4):
+            transcriber.submit(Segment(offset=float(i), pcm=b""))
+        await transcriber.parts()
+
+    with pytest.raises(RuntimeError, match="stt failed"):
+        asyncio.run(run())
+    assert sorted(cancelled) == [0.0, 2.0, 3.0]
@@ -0,0 +1,91 @@
+import asyncio
+import random
+
+import pytest
+
+from agent.stt_router import SttBackend, SttRequest, SttRouter
+
+
+class FakeBackend:
+    """指定した分布のレイテンシで応答する(または失敗する)偽のバックエンド"""
+
+    def __init__(self, name, latency, fail=False, seed=0):
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def __call__(self, request: SttRequest) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency(self.rng))
+        if self.fail:
+            raise RuntimeError(f"{self.name} failed")
+        return self.name
+
+
+def router_for(*fakes, **kwargs):
+    return SttRouter([SttBackend(f.name, f) for f in fakes], **kwargs)
+
+
+def run_requests(router, count):
+    async def run():
+        return [await router.transcribe(SttRequest()) for _ in range(count)]
+
+    return asyncio.run(run())
+
+
+def test_never_successful_backend_is_not_preferred():
+    failing = FakeBackend("failing", lambda rng: 0.001, fail=True)
+    healthy = FakeBackend("healthy", lambda rng: rng.uniform(0.002, 0.004))
+    router = router_for(failing, healthy, hedge=False)
+
+    results = run_requests(router, 20)
+
+    assert results == ["healthy"] * 20
+    # 最初の1回で失敗を計測した後は、健全なバックエンドが先に選ばれる
+    assert failing.calls == 1
+    assert router.stats()["failing"]["error_rate"] == 1.0
+
+
+def test_faster_backend_is_preferred():
+    slow = FakeBackend("slow", lambda rng: rng.uniform(0.010, 0.015))
+    fast = FakeBackend("fast", lambda rng: rng.uniform(0.001, 0.003))
+    router = router_for(slow, fast, hedge=False)
+
+    results = run_requests(router, 20)
+
+    assert results[2:] == ["fast"] * 18
+    assert slow.calls == 1
+
+
+def test_hedges_to_second_backend_on_tail_latency():
+    # 10回は速く応答し、その後は極端に遅くなる
+    latencies = iter([0.001] * 10 + [1.0] * 10)
+    primary = FakeBackend("primary", lambda rng: next(latencies))
+    secondary = FakeBackend("secondary", lambda rng: 0.005)
+    router = router_for(primary, secondary, min_hedge_samples=10)
+    # secondaryは計測済みだが遅い扱いにしておき、primaryを先に選ばせる
+    router.backends[1].record_success(0.5)
+
+    assert run_requests(router, 10) == ["primary"] * 10
+
+    async def hedged():
+        started = asyncio.get_running_loop().time()
+        result = await router.transcribe(SttRequest())
+        return result, asyncio.get_running_loop().time() - started
+
+    result, elapsed = asyncio.run(hedged())
+    assert result == "secondary"
+    assert elapsed < 0.5
+
+
+def test_circuit_opens_after_consecutive_failures():
+    failing = FakeBackend("failing", lambda rng: 0.001, fail=True)
+    router = router_for(failing, hedge=False)
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            run_requests(router, 1)
+
+    assert router.stats()["failing"]["open"]
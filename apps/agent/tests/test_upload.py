@@ -0,0 +1,151 @@
+import asyncio
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+from agent.audio import wav_to_pcm
+
+PART_SIZE = 1024
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.gate.wait()
+        if self.name in self.bucket.fail:
+            raise RuntimeError(f"upload of {self.name} failed")
+        self.bucket.objects[self.name] = bytes(data)
+
+    def compose(self, sources):
+        self.bucket.composed.append(self.name)
+        self.bucket.objects[self.name] = b"".join(
+            self.bucket.objects[source.name] for source in sources
+        )
+
+
+class FakeBucket:
+    """オブジェクトをメモリに持つ偽のバケット"""
+
+    def __init__(self):
+        self.objects = {}
+        self.composed = []
+        self.fail = set()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def delete_blobs(self, blobs, on_error=None):
+        for blob in blobs:
+            self.objects.pop(blob.name, None)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = FakeBucket()
+    storage = types.ModuleType("agent.storage")
+    storage.get_bucket = lambda: bucket
+    monkeypatch.setitem(sys.modules, "agent.storage", storage)
+    monkeypatch.delitem(sys.modules, "agent.upload", raising=False)
+    return bucket
+
+
+def new_upload(**kwargs):
+    from agent.upload import StreamingWavUpload
+
+    return StreamingWavUpload("audio/test.wav", part_size=PART_SIZE, **kwargs)
+
+
+def write_chunks(upload, pcm, chunk_size=333):
+    for start in range(0, len(pcm), chunk_size):
+        upload.write(pcm[start : start + chunk_size])
+
+
+def temporaries(bucket):
+    return [name for name in bucket.objects if ".parts/" in name]
+
+
+def test_parts_compose_back_to_the_same_pcm(bucket):
+    pcm = os.urandom(PART_SIZE * 5 + 100)
+
+    async def run():
+        upload = new_upload()
+        write_chunks(upload, pcm)
+        return await upload.close()
+
+    blob = asyncio.run(run())
+
+    assert blob.name == "audio/test.wav"
+    assert wav_to_pcm(bucket.objects["audio/test.wav"]) == (pcm, 16000)
+    assert temporaries(bucket) == []
+
+
+def test_many_parts_are_merged_before_the_compose_limit(bucket):
+    # 31パートで中間オブジェクトにまとめないと、ヘッダーと合わせて32を超える
+    pcm = os.urandom(PART_SIZE * 70)
+
+    async def run():
+        upload = new_upload()
+        write_chunks(upload, pcm, chunk_size=PART_SIZE)
+        return await upload.close()
+
+    blob = asyncio.run(run())
+
+    assert blob is not None
+    assert sum("merged-" in name for name in bucket.composed) == 2
+    assert wav_to_pcm(bucket.objects["audio/test.wav"]) == (pcm, 16000)
+    assert temporaries(bucket) == []
+
+
+def test_close_returns_none_after_a_failed_part(bucket):
+    bucket.fail.add("audio/test.wav.parts/00001")
+
+    async def run():
+        upload = new_upload()
+        write_chunks(upload, os.urandom(PART_SIZE * 4))
+        return await upload.close()
+
+    assert asyncio.run(run()) is None
+    assert "audio/test.wav" not in bucket.objects
+    assert temporaries(bucket) == []
+
+
+def test_abort_deletes_temporaries(bucket):
+    async def run():
+        upload = new_upload()
+        write_chunks(upload, os.urandom(PART_SIZE * 3))
+        await asyncio.sleep(0.05)
+        await upload.abort()
+
+    asyncio.run(run())
+
+    assert bucket.objects == {}
+
+
+def test_parts_are_spilled_to_disk_while_upload_is_blocked(bucket):
+    pcm = os.urandom(PART_SIZE * 20 + 10)
+    bucket.gate.clear()
+
+    async def run():
+        upload = new_upload(max_pending_parts=2)
+        try:
+            write_chunks(upload, pcm, chunk_size=PART_SIZE)
+            await asyncio.sleep(0.05)
+            # 送信が止まっていても、メモリに残るのは送信待ちの2パートと書きかけの分だけ
+            assert upload._in_memory == 2
+            assert len(upload._buffer) < PART_SIZE
+            assert upload.spilled == 18
+        finally:
+            bucket.gate.set()
+        return await upload.close()
+
+    assert asyncio.run(run()) is not None
+    assert wav_to_pcm(bucket.objects["audio/test.wav"]) == (pcm, 16000)